@@ -1,12 +1,14 @@
 from datetime import datetime
 import argparse
-import concurrent.futures
 import json
 import logging
 import os
+import queue
 import shutil
 import subprocess
 import sys
+import threading
+import time
 
 from utils import *
 
@@ -14,8 +16,21 @@ from utils import *
 SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
 TARGET_TP = None
 TARGET_LUFS = None
-THREAD_COUNT = None
 ERROR_COUNT = 0
+ERROR_COUNT_LOCK = threading.Lock() # shared by the stages
+# wav: yt-dlp converts the download to wav, native: the stream is kept as-is (opus/m4a), ffmpeg reads it directly
+# for the measurement and for the encode, so no wav is written (and with the loudness cache a rerun only encodes)
+DOWNLOAD_FORMATS = ["wav", "native"]
+DOWNLOAD_COMMANDS = {
+	"wav": 'yt-dlp --no-warnings -q -f bestaudio -o "{output}" --extract-audio --audio-format wav "{url}"',
+	"native": 'yt-dlp --no-warnings -q -f bestaudio -o "{output}" "{url}"',
+}
+DOWNLOAD_EXTENSIONS = {"wav": ".wav", "native": ".audio"} # ffmpeg finds out the real format from the contents
+DOWNLOAD_FORMAT = "wav"
+DOWNLOAD_COMMAND = DOWNLOAD_COMMANDS[DOWNLOAD_FORMAT]
+LOUDNESS_METER = DEFAULT_LOUDNESS_METER
+LOUDNESS_CACHE = None
+LOUDNESS_CACHE_FILE_NAME = ".loudness_cache.sqlite"
 
 def fix_file_name(name):
 	to_remove = [' - Topic', '.', "'", ':', "/", '"']
@@ -24,41 +39,150 @@ def fix_file_name(name):
 		name = name.replace(substring, '')
 	return name
 
-def dl_single_video(video):
-	global ERROR_COUNT
+def get_download_job(video):
 	# sanity check video data
 	to_check = ["title", "id", "uploader"]
 	for c in to_check:
 		if video.get(c) == None:
 			logging.error(f"could not get video data for {video}")
-			return
+			return None
 
 	# define output file name
-	logging.info(f"working on: {video['title']} [{video['id']}] ...")
-	temp_wav_file = fix_file_name(video["title"] + " - " + video["uploader"]) + ".wav"
-	output_file = temp_wav_file.replace('.wav', '.mp3')
-
-	# handle file operations and start conversion
-	if not os.path.exists(output_file):
-		if not os.path.exists(temp_wav_file):
-			dlCommand = f'yt-dlp --no-warnings -q -f bestaudio -o "{temp_wav_file}" --extract-audio --audio-format wav "https://www.youtube.com/watch?v={video["id"]}"'
-			os.system(dlCommand)
-		else:
-			logging.warning(f'skipping download for "{temp_wav_file}", already exists...')
-		status = normalize_to_mp3(temp_wav_file, output_file, TARGET_TP, TARGET_LUFS)
-		if status != True:
-			ERROR_COUNT += 1
-			os.remove(output_file)
-	else:
-		logging.warning(f'skipping output file {output_file}, already exists...')
+	base_name = fix_file_name(video["title"] + " - " + video["uploader"])
+	return {"title": video["title"], "id": video["id"], "download_file": base_name + DOWNLOAD_EXTENSIONS[DOWNLOAD_FORMAT], "output_file": base_name + ".mp3"}
+
+def download_stage(video):
+	job = get_download_job(video)
+	if job is None:
+		return None
+	if os.path.exists(job["output_file"]):
+		logging.warning(f'skipping output file {job["output_file"]}, already exists...')
+		return None
+
+	if os.path.exists(job["download_file"]):
+		logging.warning(f'skipping download for "{job["download_file"]}", already exists...')
+		return job
+	logging.info(f"downloading: {job['title']} [{job['id']}] ...")
+	url = f"https://www.youtube.com/watch?v={job['id']}"
+	result = try_command(DOWNLOAD_COMMAND.format(url=url, output=job["download_file"]), stage="download")
+	if result.returncode != 0 or not os.path.isfile(job["download_file"]):
+		raise RuntimeError(f"download failed (exit code {result.returncode}) {result.stderr.strip()}")
+	return job
+
+def analysis_stage(job):
+	job["loudness"] = get_song_loudness_data(job["download_file"], LOUDNESS_METER, LOUDNESS_CACHE)
+	return job
+
+def encode_stage(job):
+	status = encode_normalized_mp3(job["download_file"], job["output_file"], job["loudness"], TARGET_TP, TARGET_LUFS)
+	PROFILER.count("converted videos")
+	if status != True:
+		os.remove(job["output_file"])
+		raise RuntimeError("normalization was not linear, output removed")
 
 	# check and remove output files
-	if not os.path.exists(output_file):
-		logging.error(f"output file was not created: {output_file}")
-		sys.exit(1)
+	if not os.path.exists(job["output_file"]):
+		raise RuntimeError(f"output file was not created: {job['output_file']}")
+	os.remove(job["download_file"])
+	if LOUDNESS_CACHE is not None:
+		LOUDNESS_CACHE.remove(job["download_file"])
+	return job
+
+class Stage:
+	# a pool of worker threads taking jobs from a bounded queue, their results go into the next stage's queue
+	# (a full queue blocks the stage before it, so a fast download can't pile up wav files in front of a slow encode)
+	STOP = None
+
+	def __init__(self, name, function, workers, queue_size):
+		self.name = name
+		self.function = function
+		self.workers = workers
+		self.queue = queue.Queue(maxsize=max(queue_size, 1))
+		self.next = None
+		self.done = 0
+		self.failed = 0
+		self.busy = 0.0 # summed over the workers
+		self.blocked = 0.0 # time spent waiting for room in the next stage's queue
+		self.lock = threading.Lock()
+		self.threads = []
+		self.start_time = None
+
+	def start(self):
+		self.start_time = time.perf_counter()
+		self.threads = [threading.Thread(target=self.work, name=f"{self.name}-{i}") for i in range(self.workers)]
+		for thread in self.threads:
+			thread.start()
+
+	def stop(self):
+		# after the last job: one STOP per worker, then wait for them
+		for _ in self.threads:
+			self.queue.put(self.STOP)
+		for thread in self.threads:
+			thread.join()
 
-	if os.path.isfile(temp_wav_file):
-		os.remove(temp_wav_file)
+	def work(self):
+		global ERROR_COUNT
+		while True:
+			job = self.queue.get()
+			if job is self.STOP:
+				return
+			job_start = time.perf_counter()
+			try:
+				result = self.function(job)
+			except (Exception, SystemExit) as e: # SystemExit: the utils command helpers exit on failure
+				title = job.get("title", job.get("id", "?"))
+				logging.error(f"[{self.name}] {title}: {e if str(e) else 'failed'}")
+				result = None
+				with self.lock:
+					self.failed += 1
+				with ERROR_COUNT_LOCK:
+					ERROR_COUNT += 1
+			job_time = time.perf_counter() - job_start
+
+			wait_start = time.perf_counter()
+			if result is not None and self.next is not None:
+				self.next.queue.put(result)
+			with self.lock:
+				self.busy += job_time
+				self.blocked += time.perf_counter() - wait_start
+				if result is not None:
+					self.done += 1
+					self.log_progress(result)
+
+	def log_progress(self, job):
+		elapsed = time.perf_counter() - self.start_time
+		waiting = f", {self.next.queue.qsize()} waiting for {self.next.name}" if self.next is not None else ""
+		logging.info(f"[{self.name} {self.done}] {job['title']} ({self.done / elapsed * 60:.1f}/min{waiting})")
+
+	def log_summary(self, elapsed):
+		utilization = self.busy / (self.workers * elapsed) * 100 if elapsed > 0 else 0
+		per_job = self.busy / (self.done + self.failed) if self.done + self.failed > 0 else 0
+		logging.info(
+			f"{self.name:<10} {self.workers:>2} workers, {self.done:>4} done, {self.failed:>3} failed, "
+			f"{self.done / elapsed * 60 if elapsed > 0 else 0:6.1f}/min, {per_job:6.1f} s/job, {utilization:5.1f}% busy, {self.blocked:6.1f} s blocked by the next stage"
+		)
+
+def run_pipeline(videos, download_workers, analysis_workers, encode_workers, queue_size):
+	stages = [
+		Stage("download", download_stage, download_workers, queue_size),
+		Stage("analysis", analysis_stage, analysis_workers, queue_size),
+		Stage("encode", encode_stage, encode_workers, queue_size),
+	]
+	for stage, next_stage in zip(stages, stages[1:]):
+		stage.next = next_stage
+	logging.info("pipeline: " + ", ".join(f"{stage.workers} {stage.name}" for stage in stages) + f" workers, queues of {queue_size}")
+
+	start_time = time.perf_counter()
+	for stage in stages:
+		stage.start()
+	for video in videos:
+		stages[0].queue.put(video)
+	for stage in stages:
+		stage.stop()
+
+	elapsed = time.perf_counter() - start_time
+	for stage in stages:
+		stage.log_summary(elapsed)
 
 def vid_list_from_playlist(url):
 	playlistInfo = json.loads(subprocess.check_output(f'yt-dlp --no-warnings --dump-single-json --flat-playlist --playlist-end 1 "{url}"', shell=True, text=True))
@@ -92,33 +216,44 @@ def vid_list_from_file(filepath):
 	os.chdir(folder_path)
 	return videos
 
-def multithread_dl(list):
-	if THREAD_COUNT > 1:
-		logging.info(f"switching to multithreaded download with {THREAD_COUNT} threads")
-	with concurrent.futures.ThreadPoolExecutor(max_workers=THREAD_COUNT) as executor:
-		executor.map(dl_single_video, list)
-
 def main():
-	global TARGET_LUFS, TARGET_TP, THREAD_COUNT
+	global TARGET_LUFS, TARGET_TP, LOUDNESS_METER, LOUDNESS_CACHE, DOWNLOAD_FORMAT, DOWNLOAD_COMMAND
 
 	# handle arguments
 	target_tp_default = -0.1
 	target_lufs_default = -9.0
+	download_workers_default = 4
+	queue_size_default = 4
 	parser = argparse.ArgumentParser(description="Download, convert and normalize a YouTube playlist")
 	parser.add_argument('--url', help='The playlist url')
 	parser.add_argument('--file', type=str, help='Path to the video id list.')   
 	parser.add_argument('--target-tp', default=target_tp_default, help=f'Target maximum True Peak (default: {target_tp_default})')
 	parser.add_argument('--target-lufs', default=target_lufs_default, help=f'LUFS target (default: {target_lufs_default})')
+	parser.add_argument('--loudness-meter', default=DEFAULT_LOUDNESS_METER, choices=LOUDNESS_METERS, help=f'numpy: measure the loudness in-process from a single decode (loudness.py), ffmpeg: with an extra loudnorm pass (default: {DEFAULT_LOUDNESS_METER})')
+	parser.add_argument('--download-format', default=DOWNLOAD_FORMAT, choices=DOWNLOAD_FORMATS, help=f'wav: let yt-dlp convert the download to wav, native: keep the opus/m4a stream and encode straight from it, no wav is written (default: {DOWNLOAD_FORMAT})')
+	parser.add_argument('--download-command', default=None, help=f'Command that downloads {{url}} to {{output}}, as wav or in the native format, see --download-format (default: {DOWNLOAD_COMMANDS[DOWNLOAD_FORMAT]})')
+	parser.add_argument('--download-workers', type=int, default=download_workers_default, help=f'Parallel downloads (default: {download_workers_default})')
+	parser.add_argument('--analysis-workers', type=int, default=None, help='Parallel loudness measurements (default: half of the encode workers)')
+	parser.add_argument('--encode-workers', type=int, default=None, help='Parallel mp3 encodes (default: min(CPU count - 1, 8))')
+	parser.add_argument('--queue-size', type=int, default=queue_size_default, help=f'Max number of finished jobs waiting in front of the analysis and the encode stage, the stage before them pauses when it is full (default: {queue_size_default})')
+	parser.add_argument('--no-cache', action='store_true', help=f'Do not cache the loudness measurements ({LOUDNESS_CACHE_FILE_NAME} in the output folder)')
 	parser.add_argument('--debug', action='store_true', help=f'Disables multithreading and enables debug prints.')
 	parser.add_argument('--skip-normalization', action='store_true', help=f'Skips normalization alltogether.')
+	add_profile_arguments(parser)
 	args = parser.parse_args()
+	profile_start = start_profiling(args)
 
 	# initialize stuff
 	setup_logging(args.debug)
-	THREAD_COUNT = get_thread_count(args.debug)
+	encode_workers = get_thread_count(args.debug, args.encode_workers)
+	analysis_workers = get_thread_count(args.debug, args.analysis_workers if args.analysis_workers is not None else encode_workers // 2)
+	download_workers = get_thread_count(args.debug, args.download_workers)
 	check_dependencies(["ffmpeg", "yt-dlp"])
+	DOWNLOAD_FORMAT = args.download_format
+	DOWNLOAD_COMMAND = args.download_command if args.download_command is not None else DOWNLOAD_COMMANDS[DOWNLOAD_FORMAT]
 	TARGET_LUFS = float(args.target_lufs)
 	TARGET_TP = float(args.target_tp)
+	LOUDNESS_METER = args.loudness_meter
 	os.chdir(SCRIPT_DIR)
 
 	# validate user input
@@ -145,9 +280,16 @@ def main():
 	elif args.file is not None:
 		videos = vid_list_from_file(args.file)
 
+	# the videos' folder is the working directory now
+	if not args.no_cache and LOUDNESS_METER == "numpy":
+		LOUDNESS_CACHE = ResultCache(LOUDNESS_CACHE_FILE_NAME)
+
 	# start batch download
 	logging.info(f"got {len(videos)} videos")
-	multithread_dl(videos)
+	run_pipeline(videos, download_workers, analysis_workers, encode_workers, args.queue_size)
+	if LOUDNESS_CACHE is not None:
+		LOUDNESS_CACHE.close()
+	finish_profiling(args, profile_start)
 	logging.info(f"done with {ERROR_COUNT} errors, good bye...")
 
 if __name__ == "__main__":
@@ -0,0 +1,242 @@
+import argparse
+import concurrent.futures
+import json
+import os
+import sys
+import time
+import wave
+
+import numpy as np
+
+from utils import *
+
+# Landmark (constellation) fingerprints: the strongest local maxima of the spectrogram are paired with a few later peaks,
+# every pair is hashed to (anchor frequency, frequency difference, time difference) and stored with the anchor's time.
+# A segment matches a track if many of its hashes appear in the track with the same time offset.
+SAMPLE_RATE = 8000
+FFT_SIZE = 1024
+HOP_SIZE = 256 # 32 ms
+PEAK_TIME_SIZE = 9 # neighbourhood of a peak in frames
+PEAK_FREQ_SIZE = 15 # and in bins
+PEAK_MIN_LEVEL = 1.0 # log10 power above the spectrogram's median (10 dB)
+PEAKS_PER_SECOND = 20
+FAN_OUT = 5 # pairs per anchor peak
+FREQ_BITS = 9 # anchor bin 1-511
+DF_BITS = 7 # frequency difference -63..63 bins
+DT_BITS = 6 # time difference 1..63 frames (2 s)
+HASH_BITS = FREQ_BITS + DF_BITS + DT_BITS
+MAX_DF = 2 ** (DF_BITS - 1) - 1
+MAX_DT = 2 ** DT_BITS - 1
+MIN_MATCHES = 10 # hashes with the same time offset needed for a match
+INDEX_FOLDER_NAME = ".fingerprint_index"
+INDEX_VERSION = 1 # bump when the fingerprints change, the index is rebuilt then
+
+def decode_file(file_name):
+	# the whole file as mono SAMPLE_RATE float32 samples
+	command = f'ffmpeg -nostdin -hide_banner -loglevel error -i "{file_name}" -map 0:a:0 -ac 1 -ar {SAMPLE_RATE} -f s16le -acodec pcm_s16le -'
+	raw = run_command_bytes(command, stage="ffmpeg decode")
+	return np.frombuffer(raw, dtype='<i2').astype(np.float32) / 2. ** 15
+
+def read_wav_mono(file_name):
+	# a (short) wav file as mono SAMPLE_RATE float32 samples, without starting ffmpeg
+	from scipy.signal import resample_poly
+	with wave.open(file_name, 'rb') as wav_file:
+		if wav_file.getsampwidth() != 2:
+			return decode_file(file_name)
+		channels = wav_file.getnchannels()
+		frame_rate = wav_file.getframerate()
+		samples = np.frombuffer(wav_file.readframes(wav_file.getnframes()), dtype='<i2').astype(np.float32) / 2. ** 15
+	samples = samples.reshape(-1, channels).mean(axis=1)
+	if frame_rate != SAMPLE_RATE:
+		divisor = np.gcd(SAMPLE_RATE, frame_rate)
+		samples = resample_poly(samples, SAMPLE_RATE // divisor, frame_rate // divisor).astype(np.float32)
+	return samples
+
+def get_peaks(samples):
+	# (frame, bin) of the strongest local maxima of the log spectrogram, sorted by time
+	from scipy.ndimage import maximum_filter
+	if len(samples) < FFT_SIZE:
+		return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+	frames = np.lib.stride_tricks.sliding_window_view(samples, FFT_SIZE)[::HOP_SIZE]
+	spectrum = np.fft.rfft(frames * np.hanning(FFT_SIZE).astype(np.float32), axis=1)
+	spectrogram = np.log10(spectrum.real ** 2 + spectrum.imag ** 2 + 1e-10)
+
+	is_peak = spectrogram == maximum_filter(spectrogram, size=(PEAK_TIME_SIZE, PEAK_FREQ_SIZE))
+	is_peak &= spectrogram > np.median(spectrogram) + PEAK_MIN_LEVEL
+	is_peak[:, 0] = False
+	is_peak[:, 2 ** FREQ_BITS:] = False
+	peak_times, peak_bins = np.nonzero(is_peak)
+
+	# only keep the strongest ones, so loud and quiet parts are not over/under represented in the index
+	max_peaks = max(int(len(samples) / SAMPLE_RATE * PEAKS_PER_SECOND), 1)
+	if len(peak_times) > max_peaks:
+		strongest = np.argpartition(spectrogram[peak_times, peak_bins], -max_peaks)[-max_peaks:]
+		strongest.sort() # back to time order
+		peak_times, peak_bins = peak_times[strongest], peak_bins[strongest]
+	return peak_times, peak_bins
+
+def get_landmarks(samples):
+	# (hash, anchor frame) of every peak pair, the anchor paired with the next FAN_OUT peaks that fit into the target zone
+	peak_times, peak_bins = get_peaks(samples)
+	hashes = []
+	anchor_times = []
+	for distance in range(1, FAN_OUT + 1):
+		dt = peak_times[distance:] - peak_times[:-distance]
+		df = peak_bins[distance:] - peak_bins[:-distance]
+		valid = (dt > 0) & (dt <= MAX_DT) & (np.abs(df) <= MAX_DF)
+		anchor_bins = peak_bins[:-distance][valid]
+		hashes.append((anchor_bins << (DF_BITS + DT_BITS)) | ((df[valid] + MAX_DF) << DT_BITS) | dt[valid])
+		anchor_times.append(peak_times[:-distance][valid])
+	return np.concatenate(hashes).astype(np.uint32), np.concatenate(anchor_times).astype(np.uint32)
+
+def fingerprint_file(file_name):
+	PROFILER.count("fingerprinted files")
+	with PROFILER.stage("fingerprint"):
+		return get_landmarks(decode_file(file_name))
+
+class FingerprintIndex:
+	# Inverted index on disk: the landmarks of every track sorted by hash, offsets[hash]:offsets[hash + 1] is the range of the hash
+	# (a direct-address table, so a lookup is two array reads), the arrays are memory mapped when loading.
+	def __init__(self, index_dir):
+		self.index_dir = index_dir
+		with open(os.path.join(index_dir, "files.json"), 'r') as f:
+			self.files = json.load(f)["files"]
+		self.offsets = np.load(os.path.join(index_dir, "offsets.npy"), mmap_mode='r')
+		self.tracks = np.load(os.path.join(index_dir, "tracks.npy"), mmap_mode='r')
+		self.times = np.load(os.path.join(index_dir, "times.npy"), mmap_mode='r')
+
+	def match(self, samples, min_matches=MIN_MATCHES):
+		# (track title, position in the track in seconds, matching hashes) of the best match, None if nothing matches well enough
+		hashes, query_times = get_landmarks(samples)
+		if len(hashes) == 0:
+			return None
+		starts = np.asarray(self.offsets[hashes])
+		counts = np.asarray(self.offsets[hashes + 1]) - starts
+		total = int(counts.sum())
+		if total == 0:
+			return None
+
+		# every (index entry, query landmark) pair with the same hash votes for (track, time offset)
+		first_of_hash = np.cumsum(counts) - counts
+		entries = np.repeat(starts - first_of_hash, counts) + np.arange(total)
+		offsets = np.asarray(self.times[entries]).astype(np.int64) - np.repeat(query_times.astype(np.int64), counts)
+		votes = (np.asarray(self.tracks[entries]).astype(np.int64) << 32) | (offsets + 2 ** 31)
+		keys, vote_counts = np.unique(votes, return_counts=True)
+		best = np.argmax(vote_counts)
+		if vote_counts[best] < min_matches:
+			return None
+		track = int(keys[best] >> 32)
+		position = ((int(keys[best]) & 0xFFFFFFFF) - 2 ** 31) * HOP_SIZE / SAMPLE_RATE
+		return self.files[track]["title"], position, int(vote_counts[best])
+
+	def match_file(self, file_name, min_matches=MIN_MATCHES):
+		with PROFILER.stage("fingerprint lookup"):
+			return self.match(read_wav_mono(file_name), min_matches)
+
+def get_landmarks_path(index_dir, file_name):
+	return os.path.join(index_dir, "landmarks", get_file_hash(file_name) + ".npz")
+
+def load_landmarks(index_dir, file_name):
+	data = np.load(get_landmarks_path(index_dir, file_name))
+	return data["hashes"], data["times"]
+
+def save_landmarks(index_dir, file_name, hashes, times):
+	np.savez(get_landmarks_path(index_dir, file_name), hashes=hashes, times=times)
+
+def is_up_to_date(index_dir, entry, known_files):
+	known = known_files.get(entry["path"])
+	return known is not None and known["size"] == entry["size"] and known["mtime_ns"] == entry["mtime_ns"] and os.path.isfile(get_landmarks_path(index_dir, entry["path"]))
+
+def build_index(folder, index_dir, workers):
+	# (re)builds the index of every audio file in the folder, the landmarks of unchanged files are reused
+	os.makedirs(os.path.join(index_dir, "landmarks"), exist_ok=True)
+	files_path = os.path.join(index_dir, "files.json")
+	known_files = {}
+	if os.path.isfile(files_path):
+		with open(files_path, 'r') as f:
+			index_data = json.load(f)
+		if index_data["version"] == INDEX_VERSION:
+			known_files = {entry["path"]: entry for entry in index_data["files"]}
+
+	file_list = sorted(os.path.abspath(f) for f in get_files_recursive(folder) if is_audio_format(f))
+	files = []
+	for file_name in file_list:
+		size, mtime_ns = get_file_identity(file_name)
+		files.append({"path": file_name, "title": os.path.splitext(os.path.basename(file_name))[0], "size": size, "mtime_ns": mtime_ns})
+	changed = [entry["path"] for entry in files if not is_up_to_date(index_dir, entry, known_files)]
+	logging.info(f"found {len(files)} audio files, fingerprinting {len(changed)} new or changed ones on {workers} workers")
+
+	with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+		futures = {executor.submit(fingerprint_file, file_name): file_name for file_name in changed}
+		failed = set()
+		for future in concurrent.futures.as_completed(futures):
+			try:
+				hashes, times = future.result()
+			except (Exception, SystemExit) as e:
+				logging.error(f"[{futures[future]}] could not fingerprint, skipping: {e}")
+				failed.add(futures[future])
+				continue
+			save_landmarks(index_dir, futures[future], hashes, times)
+			logging.debug(f"{futures[future]}: {len(hashes)} landmarks")
+	files = [entry for entry in files if entry["path"] not in failed]
+
+	with PROFILER.stage("index build"):
+		hashes = []
+		times = []
+		tracks = []
+		for track, entry in enumerate(files):
+			track_hashes, track_times = load_landmarks(index_dir, entry["path"])
+			hashes.append(track_hashes)
+			times.append(track_times)
+			tracks.append(np.full(len(track_hashes), track, dtype=np.uint32))
+		hashes = np.concatenate(hashes) if len(hashes) > 0 else np.zeros(0, dtype=np.uint32)
+		order = np.argsort(hashes, kind='stable')
+		offsets = np.zeros(2 ** HASH_BITS + 1, dtype=np.int64)
+		np.cumsum(np.bincount(hashes, minlength=2 ** HASH_BITS), out=offsets[1:])
+		np.save(os.path.join(index_dir, "offsets.npy"), offsets)
+		np.save(os.path.join(index_dir, "tracks.npy"), np.concatenate(tracks)[order] if len(tracks) > 0 else np.zeros(0, dtype=np.uint32))
+		np.save(os.path.join(index_dir, "times.npy"), np.concatenate(times)[order] if len(times) > 0 else np.zeros(0, dtype=np.uint32))
+
+	# landmarks of removed files are not needed anymore
+	kept = {get_file_hash(entry["path"]) + ".npz" for entry in files}
+	for landmark_file in os.listdir(os.path.join(index_dir, "landmarks")):
+		if landmark_file not in kept:
+			os.remove(os.path.join(index_dir, "landmarks", landmark_file))
+	with open(files_path, 'w') as f:
+		json.dump({"version": INDEX_VERSION, "files": files}, f)
+	logging.info(f"index of {len(files)} tracks with {len(hashes)} landmarks written to {index_dir}")
+
+def main():
+	parser = argparse.ArgumentParser(description="Build a local audio fingerprint index of a music folder (used by mix_detect.py --fingerprint-index), or look up a file in it.")
+	parser.add_argument('folder', help='The music folder to index')
+	parser.add_argument('--index', default=None, help=f'The index folder (Default: {INDEX_FOLDER_NAME} in the music folder)')
+	parser.add_argument('--match', default=None, help='Do not index, look up this audio file (or a part of it, see --start and --duration) in the index instead')
+	parser.add_argument('--start', type=float, default=0, help='--match: start of the part to look up in seconds (Default: 0)')
+	parser.add_argument('--duration', type=float, default=15, help='--match: length of the part to look up in seconds (Default: 15)')
+	parser.add_argument('--workers', type=int, default=None, help='Number of worker processes, overrides the default of min(CPU count - 1, 8)')
+	parser.add_argument('--debug', action='store_true', help='Debug prints')
+	add_profile_arguments(parser)
+	args = parser.parse_args()
+	profile_start = start_profiling(args)
+	setup_logging(args.debug)
+	check_dependencies(["ffmpeg"])
+
+	index_dir = args.index if args.index is not None else os.path.join(args.folder, INDEX_FOLDER_NAME)
+	if args.match is not None:
+		samples = decode_file(args.match)[int(args.start * SAMPLE_RATE):int((args.start + args.duration) * SAMPLE_RATE)]
+		start_time = time.perf_counter()
+		match = FingerprintIndex(index_dir).match(samples)
+		logging.info(f"lookup took {(time.perf_counter() - start_time) * 1000:.1f} ms")
+		if match is None:
+			logging.info("no match")
+		else:
+			logging.info(f"{match[0]} @ {match[1]:.1f}s ({match[2]} matching landmarks)")
+	else:
+		if not os.path.isdir(args.folder):
+			logging.error("given folder not found!")
+			sys.exit(1)
+		build_index(args.folder, index_dir, get_thread_count(args.debug, args.workers))
+	finish_profiling(args, profile_start)
+
+if __name__ == '__main__':
+	main()
@@ -1,21 +1,48 @@
-from scipy.fft import fft
-from scipy.io import wavfile
+# only what every analysis needs is imported here, matplotlib and the rest of scipy are imported where they are used (startup time)
+from scipy.fft import rfft, rfftfreq
 import argparse
+import base64
 import concurrent.futures
-import matplotlib
-import matplotlib.pyplot as plt
+import functools
+import multiprocessing
 import numpy as np
 import os
 import shutil
+import struct
 import sys
 import tempfile
+import time
 
 from utils import *
-matplotlib.use('agg') # hacky fix: https://stackoverflow.com/a/74471578
+
+try:
+	import inotify_simple # optional, --watch falls back to polling without it
+except ImportError:
+	inotify_simple = None
 
 # globals
-TEMP_DIR = tempfile.mkdtemp()
 DEBUG = False
+ANALYSIS_VERSION = 4 # bump when a change makes old cached cutoff values invalid
+CACHE = None
+PROCESS_POOL = None
+CACHE_FILE_NAME = ".folder_cutoff_cache.sqlite"
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+GRID_MAX_HZ = 48000 # common frequency grid of the batch detector, enough for 96k files
+COARSE_FRAME_SIZE = 1024
+COARSE_FRAMES_PER_ROUND = 8
+COARSE_MAX_ROUNDS = 8
+COARSE_STABLE_ROUNDS = 2 # stop when the estimate didn't move more than --hz-step for this many rounds
+COARSE_MIN_DROP = 3 # the level (10 * log10 of the magnitude) has to go down this much around the estimate, or the file is full band
+COARSE_DROP_HZ = 1000 # compared: the average level this wide below and above the estimate
+FINE_FRAME_SIZE = 8192
+FINE_FRAMES = 16
+FINE_BAND_HZ = 1500 # +/- around the coarse estimate
+FINE_STEPS_PER_HZ_STEP = 4
+WATCH_POLL_SECONDS = 2
+WATCH_RESCAN_SECONDS = 30 # only without inotify
+WATCH_SETTLE_SECONDS = 5 # a file has to keep its size & mtime this long before it is analysed
 
 def get_average_by_hertz_range(data_set, wanted_hz_beginning, wanted_hz_end, samples_per_hz):
 	# Calculate the average of a range of Hz values in a dataset
@@ -24,33 +51,126 @@ def get_average_by_hertz_range(data_set, wanted_hz_beginning, wanted_hz_end, sam
 	final_cutoff = sum(data) / len(data)
 	return final_cutoff
 
-def get_song_data(samp_freq, snd):
-	# Get the time array and channel data from a sound file
-	channel = snd[:, 0]
-	time_array = np.arange(0, float(snd.shape[0]), 1)
-	time_array = time_array / samp_freq
-	time_array = time_array * 1000
-	return time_array, channel
-
-def get_cutoff(file_name, min_search_hz, hz_step, duration, downsample_size, original_filename):
-	# Calculate the cutoff frequency of a sound file
-	samp_freq, snd = wavfile.read(file_name)
-
-	if snd.dtype == np.dtype('int16'):
-		snd = snd / (2. ** 15)
-	else:
-		snd = snd / (2. ** 31)
-
+def get_window_start(song_length, duration):
+	# Start (in seconds) of the analysis window in the middle of the song, or 0 if the song is shorter than the window
+	return max(0.0, (song_length - duration) / 2)
+
+def parse_wav_header(file_name):
+	# Find the format and the data chunk of a wav file without reading the samples
+	with open(file_name, 'rb') as f:
+		riff, _, wave_id = struct.unpack('<4sI4s', f.read(12))
+		if riff != b'RIFF' or wave_id != b'WAVE':
+			raise ValueError("not a RIFF/WAVE file")
+		fmt = None
+		while True:
+			chunk_header = f.read(8)
+			if len(chunk_header) < 8:
+				raise ValueError("no data chunk found")
+			chunk_id, chunk_size = struct.unpack('<4sI', chunk_header)
+			if chunk_id == b'fmt ':
+				fmt_data = f.read(chunk_size)
+				format_tag, channels, samp_freq, _, block_align, bits = struct.unpack('<HHIIHH', fmt_data[:16])
+				if format_tag == WAVE_FORMAT_EXTENSIBLE:
+					format_tag = struct.unpack('<H', fmt_data[24:26])[0] # first 2 bytes of the sub format GUID
+				fmt = (format_tag, channels, samp_freq, block_align, bits)
+				f.seek(chunk_size % 2, os.SEEK_CUR)
+			elif chunk_id == b'data':
+				if fmt is None:
+					raise ValueError("data chunk before fmt chunk")
+				data_size = min(chunk_size, os.path.getsize(file_name) - f.tell()) # some writers leave the size unset
+				return fmt, f.tell(), data_size
+			else:
+				f.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+
+def wav_samples_to_float(raw, format_tag, bits):
+	# raw: (frames x bytes per sample) uint8 array of one channel, returns float32 samples in [-1, 1)
+	if format_tag == WAVE_FORMAT_IEEE_FLOAT:
+		return np.ascontiguousarray(raw).view('<f4' if bits == 32 else '<f8').ravel().astype(np.float32)
+	if format_tag != WAVE_FORMAT_PCM:
+		raise ValueError(f"unsupported wav format: {format_tag}")
+	if bits not in (8, 16, 24, 32):
+		raise ValueError(f"unsupported wav bit depth: {bits}")
+	return pcm_to_float(raw, bits // 8)
+
+def read_wav_window(file_name, duration):
+	# Memory-map the wav and convert only the first channel of the analysis window, the rest of the file is never read
+	(format_tag, channels, samp_freq, block_align, bits), data_offset, data_size = parse_wav_header(file_name)
+	total_frames = data_size // block_align
+	start = int(get_window_start(total_frames / samp_freq, duration) * samp_freq)
+	num_frames = min(int(samp_freq * duration), total_frames - start)
+
+	data = np.memmap(file_name, dtype=np.uint8, mode='r', offset=data_offset, shape=(total_frames, block_align))
 	try:
-		num_samples = int(samp_freq * duration)
-		snd_middle = snd[num_samples // 2: num_samples // 2 + num_samples]
-
-		freq_array, channel = get_song_data(samp_freq, snd_middle)
-
-		p = np.abs(np.fft.fft(channel))
-		p = p[:len(p) // 2]  # Take only the positive frequencies
-
-		plotHzs = np.arange(0, len(p)) * (samp_freq / len(channel))
+		raw = np.array(data[start:start + num_frames, :block_align // channels]) # first channel only
+	finally:
+		del data
+	return samp_freq, wav_samples_to_float(raw, format_tag, bits)
+
+def decode_window(file_name, duration):
+	# Let ffmpeg seek to the analysis window and pipe the first channel as raw float32, no temp files involved
+	song_length, samp_freq, _ = get_audio_info(file_name)
+	start = get_window_start(song_length, duration)
+	raw = run_command_bytes(
+		f'ffmpeg -nostdin -nostats -loglevel error -hide_banner -ss {start:.3f} -t {duration} -i "{file_name}" '
+		f'-map 0:a:0 -af "pan=mono|c0=c0" -f f32le -acodec pcm_f32le -',
+		stage="ffmpeg decode"
+	)
+	return samp_freq, np.frombuffer(raw, dtype='<f4')
+
+def read_window(file_name, duration):
+	with PROFILER.stage("decode"):
+		if os.path.splitext(file_name)[1] == ".wav":
+			return read_wav_window(file_name, duration)
+		return decode_window(file_name, duration)
+
+def get_spectrum(samp_freq, channel):
+	# Magnitude spectrum from a single FFT over the whole window
+	# the input is real, so rfft gives the positive frequencies directly (half the memory of a complex FFT)
+	with PROFILER.stage("fft"):
+		p = np.abs(np.fft.rfft(channel))
+		p = p[:len(channel) // 2]
+		hzs = np.arange(0, len(p)) * (samp_freq / len(channel))
+		return hzs, p
+
+def get_grid(hz_step):
+	# Common frequency grid for get_cutoffs, one point every hz_step
+	return np.arange(0, GRID_MAX_HZ + hz_step, hz_step, dtype=np.float64)
+
+def get_grid_spectrum(samp_freq, channel, hz_step):
+	# Smoothed dB spectrum resampled onto get_grid(hz_step), points above the file's nyquist repeat the last value (zero slope)
+	hzs, p = get_spectrum(samp_freq, channel)
+	dbs = smooth_spectrum(10 * np.log10(p))
+	return np.interp(get_grid(hz_step), hzs, dbs).astype(np.float32)
+
+def get_cutoffs(grid_hzs, spectra, min_search_hz, max_search_hzs):
+	# Vectorized version of the detection part of get_cutoff, for a stack of get_grid_spectrum results (files x bins)
+	# max_search_hzs: the search limit of every file (its nyquist), the grid goes on above it
+	# Returns one cutoff per file, nan where the spectrum never goes down
+	from scipy.ndimage import convolve1d
+	spectra = np.atleast_2d(np.asarray(spectra, dtype=np.float64))
+	with PROFILER.stage("smoothing"):
+		smoothing_window = np.hanning(11)
+		# 'nearest': zero padding would add a steep drop at the end of the grid
+		spectra = convolve1d(spectra, smoothing_window / sum(smoothing_window), axis=1, mode='nearest')
+
+	with PROFILER.stage("detection"):
+		# Exclude the initial portion
+		start_index = np.searchsorted(grid_hzs, min_search_hz)
+		search_hzs = grid_hzs[start_index:]
+		slopes = np.gradient(spectra[:, start_index:], search_hzs, axis=1)
+
+		# Max negative slope per row, below the row's limit
+		in_range = search_hzs[np.newaxis, :] <= np.reshape(max_search_hzs, (-1, 1))
+		slopes = np.where((slopes < 0) & in_range, slopes, 0)
+		indices = np.argmin(slopes, axis=1)
+		cutoffs = search_hzs[indices]
+		cutoffs[slopes[np.arange(len(slopes)), indices] == 0] = np.nan
+	return cutoffs
+
+def get_cutoff(samp_freq, channel, min_search_hz, hz_step, downsample_size, original_filename):
+	# Calculate the cutoff frequency of the analysed part of a sound file
+	try:
+		plotHzs, p = get_spectrum(samp_freq, channel)
 		plotDbs = 10 * np.log10(p)
 
 		plotHzs = np.array(plotHzs)
@@ -68,11 +188,12 @@ def get_cutoff(file_name, min_search_hz, hz_step, duration, downsample_size, ori
 		plotHzs_downsampled = plotHzs_downsampled[exclude_start_index:]
 		plotDbs_downsampled = plotDbs_downsampled[exclude_start_index:]
 
-		slopes = np.gradient(plotDbs_downsampled, plotHzs_downsampled)
+		with PROFILER.stage("detection"):
+			slopes = np.gradient(plotDbs_downsampled, plotHzs_downsampled)
 
-		# Find the index of the point with the maximum negative slope
-		valid_slope_indices = np.where(slopes < 0)[0]
-		index_max_slope = valid_slope_indices[np.argmax(np.abs(slopes[valid_slope_indices]))]
+			# Find the index of the point with the maximum negative slope
+			valid_slope_indices = np.where(slopes < 0)[0]
+			index_max_slope = valid_slope_indices[np.argmax(np.abs(slopes[valid_slope_indices]))]
 
 		# Get the x-value at the index of the maximum slope
 		x_max_slope = plotHzs_downsampled[index_max_slope]
@@ -81,6 +202,9 @@ def get_cutoff(file_name, min_search_hz, hz_step, duration, downsample_size, ori
 		sys.exit(1)
 
 	if DEBUG:
+		import matplotlib
+		matplotlib.use('agg') # hacky fix: https://stackoverflow.com/a/74471578
+		import matplotlib.pyplot as plt
 		plt.close()
 		plt.plot(plotHzs, plotDbs, color="blue")
 		plt.plot(plotHzs_downsampled, plotDbs_downsampled, color='r', linewidth=2)
@@ -88,33 +212,230 @@ def get_cutoff(file_name, min_search_hz, hz_step, duration, downsample_size, ori
 		plt.ylabel('Power (dB)')
 		plt.axvline(x=x_max_slope, color='g')
 		plt.text(0, 0, os.path.basename(original_filename), fontsize=10)
-		plt.savefig(TEMP_DIR + '/last_plot.png')
+		plt.savefig(os.path.join(tempfile.gettempdir(), 'last_plot.png'))
 		plt.show()
 
 	return x_max_slope
 
+def get_frame_positions(num_samples, frame_size, count):
+	# Evenly spread frame start positions, ordered so that every consecutive group of frames also covers the whole window
+	positions = np.linspace(0, num_samples - frame_size, count).astype(np.int64)
+	groups = max(count // COARSE_FRAMES_PER_ROUND, 1)
+	return positions.reshape(-1, groups).T.ravel() if count % groups == 0 else positions
+
+def get_drop(hzs, dbs, cutoff, max_hz):
+	# how much lower the spectrum is right above the cutoff than right below it
+	below = dbs[(hzs >= cutoff - COARSE_DROP_HZ) & (hzs < cutoff)]
+	above = dbs[(hzs > cutoff) & (hzs <= min(cutoff + COARSE_DROP_HZ, max_hz))]
+	if len(below) == 0 or len(above) == 0:
+		return 0.0
+	return float(np.mean(below) - np.mean(above))
+
+def get_coarse_cutoff(samp_freq, channel, min_search_hz, hz_step):
+	# Cheap estimate from short frames, more frames are added until it stops moving
+	# Returns the nyquist frequency for a full band file (no real drop anywhere)
+	from scipy.ndimage import convolve1d
+	frame_size = COARSE_FRAME_SIZE
+	window = np.hanning(frame_size).astype(np.float32)
+	positions = get_frame_positions(len(channel), frame_size, COARSE_FRAMES_PER_ROUND * COARSE_MAX_ROUNDS)
+	grid_hzs = get_grid(hz_step)
+	hzs = rfftfreq(frame_size, 1 / samp_freq)
+
+	power = np.zeros(frame_size // 2 + 1, dtype=np.float64)
+	frame_count = 0
+	estimates = []
+	for round_index in range(COARSE_MAX_ROUNDS):
+		round_positions = positions[round_index * COARSE_FRAMES_PER_ROUND:(round_index + 1) * COARSE_FRAMES_PER_ROUND]
+		frames = np.stack([channel[p:p + frame_size] for p in round_positions]).astype(np.float32) * window
+		spectrum = rfft(frames, axis=1)
+		power += np.sum(spectrum.real ** 2 + spectrum.imag ** 2, axis=0)
+		frame_count += len(frames)
+
+		# averaged, so the dB level doesn't depend on the number of rounds, and smoothed without zero padding (no fake drop at nyquist)
+		smoothing_window = np.hanning(11)
+		dbs = convolve1d(10 * np.log10(np.sqrt(power / frame_count)), smoothing_window / sum(smoothing_window), mode='nearest')
+		estimates.append(get_cutoffs(grid_hzs, np.interp(grid_hzs, hzs, dbs), min_search_hz, samp_freq / 2)[0])
+		recent = estimates[-(COARSE_STABLE_ROUNDS + 1):]
+		if len(recent) > COARSE_STABLE_ROUNDS and np.ptp(recent) <= hz_step:
+			break
+	estimate = min(estimates[-1], samp_freq / 2)
+	if np.isnan(estimate) or get_drop(hzs, dbs, estimate, samp_freq / 2) < COARSE_MIN_DROP:
+		return samp_freq / 2, frame_count
+	return estimate, frame_count
+
+def get_band_spectrum(samp_freq, channel, band_start, band_end, num_bins):
+	# Averaged magnitudes of num_bins frequencies between band_start and band_end only (zoom FFT), instead of a full resolution spectrum
+	from scipy.signal import ZoomFFT
+	frame_size = min(FINE_FRAME_SIZE, len(channel))
+	window = np.hanning(frame_size).astype(np.float32)
+	positions = get_frame_positions(len(channel), frame_size, FINE_FRAMES)
+	frames = np.stack([channel[p:p + frame_size] for p in positions]).astype(np.float32) * window
+
+	zoom_fft = ZoomFFT(frame_size, [band_start, band_end], m=num_bins, fs=samp_freq, endpoint=True)
+	spectrum = zoom_fft(frames, axis=-1)
+	return np.sqrt(np.mean(spectrum.real ** 2 + spectrum.imag ** 2, axis=0))
+
+def get_cutoff_coarse_to_fine(samp_freq, channel, min_search_hz, hz_step, original_filename):
+	# Calculate the cutoff frequency from a low resolution estimate, refined with high resolution bins around it only
+	from scipy.ndimage import convolve1d
+	try:
+		with PROFILER.stage("coarse estimate"):
+			coarse_cutoff, coarse_frames = get_coarse_cutoff(samp_freq, channel, min_search_hz, hz_step)
+
+		fine_step = hz_step / FINE_STEPS_PER_HZ_STEP
+		band_start = max(coarse_cutoff - FINE_BAND_HZ, min_search_hz)
+		band_end = min(coarse_cutoff + FINE_BAND_HZ, samp_freq / 2)
+		if coarse_cutoff >= samp_freq / 2 or band_start >= band_end:
+			# full band or an estimate at the edge of the search range, nothing to refine
+			logging.debug(f'[{original_filename}] coarse estimate {coarse_cutoff} from {coarse_frames} frames, no band to refine')
+			return float(coarse_cutoff)
+		num_bins = int((band_end - band_start) / fine_step) + 1
+		band_hzs = np.linspace(band_start, band_end, num_bins)
+		with PROFILER.stage("fft"):
+			band_dbs = 10 * np.log10(get_band_spectrum(samp_freq, channel, band_start, band_end, num_bins))
+
+		with PROFILER.stage("smoothing"):
+			smoothing_window = np.hanning(11)
+			band_dbs = convolve1d(band_dbs, smoothing_window / sum(smoothing_window), mode='nearest')
+		with PROFILER.stage("detection"):
+			slopes = np.gradient(band_dbs, band_hzs)
+			edge = len(smoothing_window) // 2
+			fine_cutoff = band_hzs[edge + np.argmin(slopes[edge:len(slopes) - edge])]
+	except Exception as e:
+		logging.error(f'[{original_filename}] error while doing math: {e}')
+		sys.exit(1)
+
+	logging.debug(f'[{original_filename}] coarse estimate {coarse_cutoff} from {coarse_frames} frames, refined to {fine_cutoff}')
+	return float(fine_cutoff)
+
+def init_worker(debug):
+	# process pool initializer, the workers don't inherit the globals set in main()
+	global DEBUG
+	DEBUG = debug
+
+def run_shared(func, profile, shm_name, shape, dtype, samp_freq, *func_args):
+	# Runs func(samp_freq, channel, *func_args) in the process pool, the samples are passed in shared memory instead of being pickled
+	# Returns (result, the profiler numbers of this call or None)
+	PROFILER.reset(profile)
+	shm, channel = attach_shared_array(shm_name, shape, dtype)
+	try:
+		result = func(samp_freq, channel, *func_args)
+		return result, PROFILER.export() if profile else None
+	finally:
+		del channel
+		shm.close()
+
 def smooth_spectrum(spectrum, window_size=11):
-	window = np.hanning(window_size)
-	smoothed = np.convolve(spectrum, window, mode='same') / sum(window)
+	with PROFILER.stage("smoothing"):
+		window = np.hanning(window_size)
+		smoothed = np.convolve(spectrum, window, mode='same') / sum(window)
 	return smoothed
 
+def get_analysis_params(args):
+	# every argument that changes the cutoff value, cached results are only reused if these match
+	return {
+		"version": ANALYSIS_VERSION,
+		"min_search_hz": args.min_search_hz,
+		"hz_step": args.hz_step,
+		"duration": args.duration,
+		"downsample_size": args.downsample_size,
+		"detector": args.detector,
+	}
+
+def get_spectrum_params(args):
+	# same for the batch mode spectra, these don't depend on --min-search-hz so they can be re-evaluated without decoding
+	return {
+		"version": ANALYSIS_VERSION,
+		"kind": "grid_spectrum",
+		"encoding": "f32le base64",
+		"hz_step": args.hz_step,
+		"duration": args.duration,
+	}
+
+def run_math(func, samp_freq, channel, *func_args):
+	if PROCESS_POOL is None:
+		return func(samp_freq, channel, *func_args)
+
+	# hybrid mode: this thread did the decoding, the math runs in a worker process
+	shm = create_shared_array(channel)
+	try:
+		future = PROCESS_POOL.submit(run_shared, func, PROFILER.enabled, shm.name, channel.shape, channel.dtype.str, samp_freq, *func_args)
+		result, profile = future.result()
+		if profile is not None:
+			PROFILER.merge(profile)
+		return result
+	finally:
+		shm.close()
+		shm.unlink()
+
+def cached(file_name, params, func, *func_args):
+	# func(*func_args), unless the cache already has the result for this file & params
+	result = None
+	if CACHE is not None:
+		result = CACHE.get(file_name, params)
+	if result is None:
+		result = func(*func_args)
+		if CACHE is not None:
+			CACHE.put(file_name, params, result)
+	return result
+
+def analyze(file_name, args):
+	samp_freq, channel = read_window(file_name, args.duration)
+	if args.detector == "coarse-to-fine":
+		return run_math(get_cutoff_coarse_to_fine, samp_freq, channel, args.min_search_hz, args.hz_step, file_name)
+	return run_math(get_cutoff, samp_freq, channel, args.min_search_hz, args.hz_step, args.downsample_size, file_name)
+
+def analyze_spectrum(file_name, args):
+	# the spectrum goes into the cache as its float32 bytes (base64, the cache stores JSON), not as a list of floats
+	samp_freq, channel = read_window(file_name, args.duration)
+	spectrum = run_math(get_grid_spectrum, samp_freq, channel, args.hz_step)
+	return {"samp_freq": samp_freq, "spectrum": base64.b64encode(spectrum.astype('<f4').tobytes()).decode("ascii")}
+
 def process(file_name, args):
+	PROFILER.count("files")
+	cutoff = cached(file_name, get_analysis_params(args), analyze, file_name, args)
+	apply_action(file_name, cutoff, args)
+
+def log_failure(file_name, future):
+	# done-callback of a process() future
+	error = future.exception()
+	if isinstance(error, FileNotFoundError):
+		logging.info(f'[{file_name}] disappeared, skipping')
+	elif error is not None and not isinstance(error, SystemExit): # SystemExit: the reason is already logged
+		logging.error(f'[{file_name}] analysis failed: {error}')
+
+def process_batch(file_list, executor, args):
+	# 1. grid spectra of every file (decoded or cached), 2. one vectorized detection for all of them, 3. the usual actions
+	params = get_spectrum_params(args)
+	PROFILER.count("files", len(file_list))
+	futures = [executor.submit(cached, f, params, analyze_spectrum, f, args) for f in file_list]
+	analyzed = []
+	for f, future in zip(file_list, futures):
+		error = future.exception()
+		if error is None:
+			analyzed.append((f, future.result()))
+		elif isinstance(error, FileNotFoundError):
+			logging.info(f'[{f}] disappeared, skipping')
+		elif isinstance(error, SystemExit):
+			logging.error(f'[{f}] analysis failed, skipping') # the reason is already logged
+		else:
+			logging.error(f'[{f}] analysis failed, skipping: {error}')
+	if len(analyzed) == 0:
+		return
+
+	spectra = [np.frombuffer(base64.b64decode(result["spectrum"]), dtype='<f4') for _, result in analyzed]
+	nyquists = [result["samp_freq"] / 2 for _, result in analyzed]
+	cutoffs = get_cutoffs(get_grid(args.hz_step), spectra, args.min_search_hz, nyquists)
+	for (file_name, _), cutoff in zip(analyzed, cutoffs):
+		if np.isnan(cutoff):
+			logging.error(f'[{file_name}] could not find the cutoff, the spectrum never goes down')
+			continue
+		apply_action(file_name, float(cutoff), args)
+
+def apply_action(file_name, cutoff, args):
 	original_file_name = file_name
 	file_format = os.path.splitext(file_name)[1]
-	wasnt_wav = None
 
-	# convert if needed & get cutoff value
-	if file_format != ".wav":
-		temp_file_name = os.path.join(TEMP_DIR, get_file_hash(file_name) + '.wav')
-		run_command(f'ffmpeg -y -nostats -loglevel panic -hide_banner -i "{file_name}" "{temp_file_name}"')
-		file_name = temp_file_name
-		wasnt_wav = True
-
-	cutoff = get_cutoff(temp_file_name, args.min_search_hz, args.hz_step, args.duration, args.downsample_size, file_name)
-
-	if wasnt_wav == True:
-		os.remove(temp_file_name)
-		
 	mark = "✓" if cutoff >= args.accepted_hz else "✕"
 	mark = f" {mark} "
 	logging.info(f"{mark} {original_file_name} : {cutoff}")
@@ -122,18 +443,121 @@ def process(file_name, args):
 	if args.action == "delete":
 		logging.warning(f"deleting {original_file_name}")
 		os.remove(original_file_name)
+		if CACHE is not None:
+			CACHE.remove(original_file_name)
 
 	if args.action == "rename":
 		if cutoff <= args.accepted_hz:
-			if '!' not in os.path.splitext(os.path.basename(original_file_name))[0]:
+			if not is_marked(original_file_name):
 				new_file_name = os.path.dirname(original_file_name) + '/!' + os.path.splitext(os.path.basename(original_file_name))[0] + '_' + str(round(cutoff / 1000)) + "k" + file_format
 				shutil.move(original_file_name, new_file_name)
+				if CACHE is not None:
+					CACHE.move(original_file_name, new_file_name)
 				#logging.info(f"Renamed '{original_file_name}' to '{new_file_name}'")
 			else:
 				logging.warning(f'skipping rename: {original_file_name}, seems to be already renamed')
 
+def is_marked(file_name):
+	# True if the rename action already did its thing on this file
+	return '!' in os.path.splitext(os.path.basename(file_name))[0]
+
+class FolderWatcher:
+	# Reports created/modified files under a folder, via inotify if inotify_simple is installed, by rescanning the folder otherwise
+	def __init__(self, folder, known_files):
+		self.folder = folder
+		if inotify_simple is not None:
+			self.backend = "inotify"
+			self.inotify = inotify_simple.INotify()
+			self.watch_flags = inotify_simple.flags.CLOSE_WRITE | inotify_simple.flags.MOVED_TO | inotify_simple.flags.CREATE
+			self.watched_dirs = {}
+			for root, _, _ in os.walk(folder):
+				self.add_watch(root)
+		else:
+			self.backend = "polling"
+			self.identities = {f: get_file_identity(f) for f in known_files if os.path.isfile(f)}
+			self.last_scan = time.monotonic()
+
+	def add_watch(self, directory):
+		self.watched_dirs[self.inotify.add_watch(directory, self.watch_flags)] = directory
+
+	def poll(self, timeout):
+		if self.backend == "inotify":
+			return self.poll_inotify(timeout)
+		return self.poll_rescan(timeout)
+
+	def poll_inotify(self, timeout):
+		changed = []
+		for event in self.inotify.read(timeout=int(timeout * 1000)):
+			if event.wd not in self.watched_dirs:
+				continue
+			path = os.path.join(self.watched_dirs[event.wd], event.name)
+			if event.mask & inotify_simple.flags.ISDIR:
+				# new folder: watch it and pick up whatever got in there before the watch
+				for root, _, _ in os.walk(path):
+					self.add_watch(root)
+				changed.extend(get_files_recursive(path))
+			else:
+				changed.append(path)
+		return changed
+
+	def poll_rescan(self, timeout):
+		time.sleep(timeout)
+		if time.monotonic() - self.last_scan < WATCH_RESCAN_SECONDS:
+			return []
+		self.last_scan = time.monotonic()
+		changed = []
+		identities = {}
+		for f in get_files_recursive(self.folder):
+			try:
+				identities[f] = get_file_identity(f)
+			except FileNotFoundError:
+				continue
+			if self.identities.get(f) != identities[f]:
+				changed.append(f)
+		self.identities = identities
+		return changed
+
+def watch(folder, known_files, executor, args):
+	# Keep running: analyse new or modified audio files once they stopped changing
+	watcher = FolderWatcher(folder, known_files)
+	logging.info(f"watching {folder} for new files ({watcher.backend}), press ctrl+c to stop")
+	pending = {} # path -> (identity, time of the last change)
+	try:
+		while True:
+			now = time.monotonic()
+			for f in watcher.poll(WATCH_POLL_SECONDS):
+				if is_audio_format(f) and not (args.action == "rename" and is_marked(f)):
+					pending[f] = (None, now)
+
+			ready = []
+			for f, (identity, changed_at) in list(pending.items()):
+				try:
+					current_identity = get_file_identity(f)
+				except FileNotFoundError:
+					del pending[f]
+					continue
+				if current_identity != identity:
+					pending[f] = (current_identity, now) # still being written
+				elif now - changed_at >= WATCH_SETTLE_SECONDS:
+					ready.append(f)
+					del pending[f]
+
+			if len(ready) > 0:
+				ready.sort()
+				logging.info(f"found {len(ready)} new or modified audio files")
+				if args.batch:
+					process_batch(ready, executor, args)
+				else:
+					for f in ready:
+						future = executor.submit(process, f, args)
+						future.add_done_callback(functools.partial(log_failure, f))
+			if CACHE is not None:
+				CACHE.flush()
+	except KeyboardInterrupt:
+		logging.info("stopped watching")
+
 def main():
-	global DEBUG
+	global DEBUG, CACHE, PROCESS_POOL
 	# handle arguments
 	parser = argparse.ArgumentParser(description="Analyse music files' quality in a given folder.")
 	default_min_search_hz = 10000
@@ -142,18 +566,28 @@ def main():
 	default_duration = 60
 	default_downsample_size = 200
 	default_action = "rename"
+	default_executor = "threads"
+	default_detector = "full"
 	parser.add_argument('folder', help='The folder to search for audio files in')
 	parser.add_argument('--min-search-hz', type=int, default=default_min_search_hz, help=f'Start the search from this frequency. (Default: {default_min_search_hz})')
 	parser.add_argument('--accepted-hz', type=int, default=default_accepted_hz, help=f'The accepted cutoff frequency. We will accept these files and not throw warnings. (Default: {default_accepted_hz})')
 	parser.add_argument('--hz-step', type=int, default=default_hz_step, help=f'The step size for frequency search (Default: {default_hz_step})')
 	parser.add_argument('--duration', type=int, default=default_duration, help=f'Duration of the portion of the song to analyze in seconds (from the middle of the song) (Default: {default_duration})')
 	parser.add_argument('--downsample-size', type=int, default=default_downsample_size, help=f'Size to use while downsampling (Default: {default_downsample_size})')
+	parser.add_argument('--detector', default=default_detector, choices=["full", "coarse-to-fine"], help=f'full: search the full spectrum, coarse-to-fine: estimate from a few short frames, then refine with fine bins around the estimate only (not used with --batch) (Default: {default_detector})')
 	parser.add_argument('--action', default=default_action, type=str, help=f'Action to do on the misbehaving song. Actions: nothing, rename or delete. (Default: {default_action})')
+	parser.add_argument('--executor', default=default_executor, choices=["threads", "hybrid"], help=f'threads: everything runs in a thread pool, hybrid: threads decode, a process pool does the math (Default: {default_executor})')
+	parser.add_argument('--workers', type=int, default=None, help='Number of workers, overrides the default of min(CPU count - 1, 8)')
+	parser.add_argument('--batch', action='store_true', help='Compute & cache a spectrum for every file first, then detect all cutoffs in one vectorized step. Changing --min-search-hz or --accepted-hz later does not need any decoding. (--downsample-size is not used, the spectra are on a --hz-step grid)')
+	parser.add_argument('--watch', action='store_true', help='After the initial scan keep running and analyse new or modified files in the folder (uses inotify if inotify_simple is installed, polling otherwise)')
+	parser.add_argument('--no-cache', action='store_true', help=f'Do not read or write the result cache ({CACHE_FILE_NAME} in the given folder)')
 	parser.add_argument('--debug', action='store_true', help=f'Debug prints and graphs')
+	add_profile_arguments(parser)
 	args = parser.parse_args()
+	profile_start = start_profiling(args)
 
 	# init
-	check_dependencies("ffmpeg")
+	check_dependencies(["ffmpeg", "ffprobe"])
 	DEBUG = args.debug
 	setup_logging(DEBUG)
 	
@@ -178,15 +612,40 @@ def main():
 	file_list.sort()
 	logging.info(f"found {len(file_list)} audio files")
 
+	if not args.no_cache:
+		CACHE = ResultCache(os.path.join(args.folder, CACHE_FILE_NAME))
+
 	# start multithreaded work
-	cpu_count = get_thread_count(DEBUG)
+	cpu_count = get_thread_count(DEBUG, args.workers)
+	logging.info(f"running with {cpu_count} {args.executor} workers")
+	start_time = time.perf_counter()
+	if args.executor == "hybrid":
+		# the workers start on the first submit, from inside a decode thread: forking this process then would copy
+		# it mid-work (other threads' locks, the sqlite connection), so they are started from a clean forkserver instead
+		start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+		PROCESS_POOL = concurrent.futures.ProcessPoolExecutor(max_workers=cpu_count, mp_context=multiprocessing.get_context(start_method), initializer=init_worker, initargs=(DEBUG,))
 	with concurrent.futures.ThreadPoolExecutor(max_workers=cpu_count) as executor:
-		futures = []
-		for f in file_list:
-			future = executor.submit(process, f, args)
-			futures.append(future)
-		concurrent.futures.wait(futures) # wait for all tasks to complete
-	os.removedirs(TEMP_DIR)
+		if args.batch:
+			process_batch(file_list, executor, args)
+		else:
+			futures = []
+			for f in file_list:
+				future = executor.submit(process, f, args)
+				futures.append(future)
+			concurrent.futures.wait(futures) # wait for all tasks to complete
+			for f, future in zip(file_list, futures):
+				log_failure(f, future)
+		elapsed = time.perf_counter() - start_time
+		logging.info(f"processed {len(file_list)} files in {elapsed:.1f}s ({len(file_list) / max(elapsed, 1e-9):.2f} files/s)")
+
+		if args.watch:
+			watch(args.folder, file_list, executor, args)
+	if PROCESS_POOL is not None:
+		PROCESS_POOL.shutdown()
+	if CACHE is not None:
+		CACHE.close()
+		logging.info(f"cache hits: {CACHE.hits}, misses: {CACHE.misses}")
+	finish_profiling(args, profile_start)
 	logging.info("done, bye")
 
 if __name__ == '__main__':
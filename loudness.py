@@ -0,0 +1,192 @@
+import argparse
+import os
+import sys
+
+import numpy as np
+
+from utils import *
+
+# ITU-R BS.1770 / EBU R128 loudness of a whole file from one decode, measured like ffmpeg's loudnorm filter does:
+# integrated loudness of the 400 ms blocks (100 ms step) above the -70 LUFS absolute and the -10 LU relative gate,
+# loudness range of the 3 s blocks (1 s step) between their 10th and 95th percentile (EBU Tech 3342), and oversampled true peak.
+METER_VERSION = 1 # bump when the measurement changes, old cached values are not used then
+ABSOLUTE_GATE = -70.0
+RELATIVE_GATE = -10.0
+LRA_RELATIVE_GATE = -20.0
+LRA_LOW_PERCENTILE = 0.10
+LRA_HIGH_PERCENTILE = 0.95
+CHANNEL_WEIGHTS = [1.0, 1.0, 1.0, 0.0, 1.41, 1.41] # L, R, C, LFE, Ls, Rs
+TRUE_PEAK_CHUNK = 1.0 # seconds oversampled at once
+DECODE_BLOCK = 5 # seconds read from ffmpeg at once
+COMPARE_TOLERANCE = 0.1 # LU / dB, --compare fails above this
+
+def iter_decoded_blocks(file_name, channels, sample_rate):
+	# every channel of the file as float32 samples (frames x channels), DECODE_BLOCK seconds at a time from an ffmpeg pipe
+	frame_bytes = 4 * channels
+	block_bytes = int(DECODE_BLOCK * sample_rate) * frame_bytes
+	command = f'ffmpeg -nostdin -hide_banner -loglevel error -i "{file_name}" -map 0:a:0 -f f32le -acodec pcm_f32le -'
+	for raw in iter_ffmpeg_pcm(command, frame_bytes, block_bytes):
+		yield np.frombuffer(raw, dtype='<f4').reshape(-1, channels)
+
+def get_k_weighting(sample_rate):
+	# the two biquads of the K-weighting (high shelf, then high pass) for any sample rate, as second-order sections
+	f0 = 1681.974450955533
+	gain = 3.999843853973347
+	q = 0.7071752369554196
+	k = np.tan(np.pi * f0 / sample_rate)
+	vh = 10 ** (gain / 20)
+	vb = vh ** 0.4996667741545416
+	a0 = 1 + k / q + k * k
+	shelf = [(vh + vb * k / q + k * k) / a0, 2 * (k * k - vh) / a0, (vh - vb * k / q + k * k) / a0, 1, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0]
+
+	f0 = 38.13547087602444
+	q = 0.5003270373238773
+	k = np.tan(np.pi * f0 / sample_rate)
+	a0 = 1 + k / q + k * k
+	high_pass = [1, -2, 1, 1, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0]
+	return np.array([shelf, high_pass])
+
+def to_lufs(energy):
+	with np.errstate(divide='ignore'):
+		return -0.691 + 10 * np.log10(energy)
+
+def get_block_energies(subblocks):
+	# mean square of the 400 ms and the 3 s blocks, from the mean squares of the 100 ms subblocks
+	sums = np.concatenate([[0.0], np.cumsum(subblocks)])
+	subblock_count = len(subblocks)
+	momentary_starts = np.arange(0, subblock_count - 3)
+	momentary = (sums[momentary_starts + 4] - sums[momentary_starts]) / 4
+	short_term_starts = np.arange(0, subblock_count - 29, 10)
+	short_term = (sums[short_term_starts + 30] - sums[short_term_starts]) / 30
+	return momentary, short_term
+
+def get_integrated_loudness(momentary):
+	# (integrated loudness, relative gate threshold) in LUFS
+	gated = momentary[to_lufs(momentary) >= ABSOLUTE_GATE]
+	if len(gated) == 0:
+		return -np.inf, -np.inf
+	threshold = to_lufs(np.mean(gated)) + RELATIVE_GATE
+	gated = gated[to_lufs(gated) >= threshold]
+	return float(to_lufs(np.mean(gated))), float(threshold)
+
+def get_loudness_range(short_term):
+	gated = short_term[to_lufs(short_term) >= ABSOLUTE_GATE]
+	if len(gated) == 0:
+		return 0.0
+	threshold = to_lufs(np.mean(gated)) + LRA_RELATIVE_GATE
+	loudness = np.sort(to_lufs(gated[to_lufs(gated) >= threshold]))
+	low = loudness[int((len(loudness) - 1) * LRA_LOW_PERCENTILE + 0.5)]
+	high = loudness[int((len(loudness) - 1) * LRA_HIGH_PERCENTILE + 0.5)]
+	return float(high - low)
+
+class LoudnessMeter:
+	# add() the samples block by block, only the energy of every 100 ms and the samples not checked for the true peak yet are kept,
+	# so memory doesn't grow with the file's length (past a few bytes per 100 ms)
+	def __init__(self, sample_rate, channels):
+		from scipy.signal import firwin
+		self.k_weighting = get_k_weighting(sample_rate)
+		self.filter_state = np.zeros((len(self.k_weighting), 2, channels))
+		self.weights = np.array([CHANNEL_WEIGHTS[c] if c < len(CHANNEL_WEIGHTS) else 1.0 for c in range(channels)])
+		self.samples_in_100ms = (sample_rate + 5) // 10
+		self.partial_subblock = np.zeros(0) # weighted energy of the samples after the last full 100 ms
+		self.subblocks = []
+
+		# true peak: max |sample| after 4x oversampling (2x from 96 kHz). A chunk is only oversampled if it can change the result:
+		# it can't go above its sample peak times the largest gain of a phase of the interpolation filter.
+		self.factor = 4 if sample_rate < 96000 else 2
+		self.half_length = 10 * self.factor # resample_poly's default filter
+		taps = firwin(2 * self.half_length + 1, 1 / self.factor, window=('kaiser', 5.0)) * self.factor
+		self.max_gain = max(np.abs(taps[phase::self.factor]).sum() for phase in range(self.factor))
+		self.chunk_size = int(TRUE_PEAK_CHUNK * sample_rate)
+		self.pending = np.zeros((0, channels), dtype=np.float32) # half a filter of context, then the samples not checked yet
+		self.context = 0
+		self.peak = 0.0
+
+	def add(self, samples):
+		from scipy.signal import sosfilt
+		with PROFILER.stage("loudness meter"):
+			filtered, self.filter_state = sosfilt(self.k_weighting, samples, axis=0, zi=self.filter_state)
+			energies = np.concatenate([self.partial_subblock, np.square(filtered) @ self.weights])
+			count = len(energies) // self.samples_in_100ms
+			self.subblocks.append(energies[:count * self.samples_in_100ms].reshape(count, self.samples_in_100ms).sum(axis=1) / self.samples_in_100ms)
+			self.partial_subblock = energies[count * self.samples_in_100ms:]
+
+			self.pending = np.concatenate([self.pending, samples])
+			self.check_peaks(False)
+
+	def check_peaks(self, is_last):
+		# with half a filter of context on both sides, so the chunk's own part is interpolated exactly (the file's ends are zero padded)
+		from scipy.signal import resample_poly
+		while True:
+			available = len(self.pending) - self.context
+			if available <= 0 or (not is_last and available < self.chunk_size + self.half_length):
+				return
+			end = self.context + min(self.chunk_size, available)
+			chunk_peak = float(np.abs(self.pending[self.context:end]).max())
+			if chunk_peak * self.max_gain > self.peak:
+				context_end = min(end + self.half_length, len(self.pending))
+				oversampled = resample_poly(self.pending[:context_end], self.factor, 1, axis=0)
+				chunk_peak = max(chunk_peak, float(np.abs(oversampled[self.context * self.factor:end * self.factor]).max()))
+			self.peak = max(self.peak, chunk_peak)
+
+			keep_from = max(end - self.half_length, 0)
+			self.pending = self.pending[keep_from:]
+			self.context = end - keep_from
+
+	def result(self):
+		# (integrated LUFS, true peak dBTP, loudness range LU, relative gate threshold LUFS), the input_* values of loudnorm
+		with PROFILER.stage("loudness meter"):
+			self.check_peaks(True)
+			momentary, short_term = get_block_energies(np.concatenate(self.subblocks) if len(self.subblocks) > 0 else np.zeros(0))
+			integrated, threshold = get_integrated_loudness(momentary)
+			with np.errstate(divide='ignore'):
+				true_peak = float(20 * np.log10(self.peak))
+			return integrated, true_peak, get_loudness_range(short_term), threshold
+
+def measure_file(file_name, cache=None):
+	# LoudnessMeter result of a file, from the cache (ResultCache) if it has the file unchanged
+	params = {"kind": "loudness", "version": METER_VERSION}
+	if cache is not None:
+		cached = cache.get(file_name, params)
+		if cached is not None:
+			return tuple(cached)
+	_, sample_rate, channels = get_audio_info(file_name)
+	meter = LoudnessMeter(sample_rate, channels)
+	for samples in iter_decoded_blocks(file_name, channels, sample_rate):
+		meter.add(samples)
+	result = meter.result()
+	if cache is not None:
+		cache.put(file_name, params, list(result))
+	return result
+
+def main():
+	parser = argparse.ArgumentParser(description="Measure the EBU R128 loudness of audio files (integrated, true peak, LRA) without ffmpeg's loudnorm.")
+	parser.add_argument('files', nargs='+', help='Audio files to measure')
+	parser.add_argument('--compare', action='store_true', help=f"Also measure with ffmpeg's loudnorm filter and fail if a value differs more than {COMPARE_TOLERANCE}")
+	parser.add_argument('--debug', action='store_true', help='Debug prints')
+	add_profile_arguments(parser)
+	args = parser.parse_args()
+	profile_start = start_profiling(args)
+	setup_logging(args.debug)
+	check_dependencies(["ffmpeg", "ffprobe"])
+
+	failed = False
+	for file_name in args.files:
+		if not os.path.isfile(file_name):
+			logging.error(f"file not found: {file_name}")
+			sys.exit(1)
+		measured = measure_file(file_name)
+		logging.info(f"{file_name}: I = {measured[0]:.2f} LUFS, TP = {measured[1]:.2f} dBTP, LRA = {measured[2]:.2f} LU, threshold = {measured[3]:.2f} LUFS")
+		if args.compare:
+			reference = get_song_loudness_data(file_name, meter="ffmpeg")
+			differences = [abs(a - b) for a, b in zip(measured, reference)]
+			mark = "✓" if max(differences) <= COMPARE_TOLERANCE else "✕"
+			failed |= max(differences) > COMPARE_TOLERANCE
+			logging.info(f" {mark} ffmpeg: I = {reference[0]:.2f}, TP = {reference[1]:.2f}, LRA = {reference[2]:.2f}, threshold = {reference[3]:.2f} (max difference {max(differences):.3f})")
+
+	finish_profiling(args, profile_start)
+	if failed:
+		sys.exit(1)
+
+if __name__ == '__main__':
+	main()
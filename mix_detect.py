@@ -1,9 +1,14 @@
 import argparse
+import collections
+import concurrent.futures
+import threading
+import time
 import wave
 import os
 import shutil
 import subprocess
 import json
+import math
 import tempfile
 from datetime import datetime, timedelta
 import sys
@@ -14,6 +19,22 @@ from utils import *
 
 TEMP_DIR = os.path.join(tempfile.gettempdir(), "mixdetect_temp")
 DEBUG = False
+CACHE = None
+LIMITER = None
+FINGERPRINT_INDEX = None
+CACHE_FILE_NAME = ".mix_detect_cache.sqlite"
+DEFAULT_RECOGNIZER = 'songrec audio-file-to-recognized-song "{file}"'
+RETRY_BACKOFF = 2 # seconds before the first retry, doubled for every next one
+SEGMENTS_PER_WORKER = 2 # segments waiting on disk per recognition worker
+SEGMENT_SAMPLE_RATE = 16000
+SHM_DIR = "/dev/shm"
+NOVELTY_SAMPLE_RATE = 8000 # the transition detection only needs a rough spectrum
+NOVELTY_MIN_HZ = 40
+NOVELTY_BANDS = 16
+NOVELTY_FRAMES_PER_READ = 60
+NOVELTY_CONTEXT = 8 # seconds compared before and after every point
+MIN_TRANSITION_GAP = 30 # seconds, shorter tracks are still probed, but not split further
+TRANSITION_MARGIN = 5 # seconds between a transition and the first probe after it (the mixing is usually still going on)
 
 class Result:
 	def __init__(self, title, segment_name):
@@ -31,6 +52,21 @@ class Result:
 	def __str__(self):
 		return f'{self.title} @ {self.timestamp}'
 
+class RateLimiter:
+	# spaces out the start of the calls of every thread to at most requests_per_second (0: no limit)
+	def __init__(self, requests_per_second):
+		self.interval = 1 / requests_per_second if requests_per_second > 0 else 0
+		self.next_time = 0
+		self.lock = threading.Lock()
+
+	def wait(self):
+		with self.lock:
+			now = time.monotonic()
+			start_time = max(self.next_time, now)
+			self.next_time = start_time + self.interval
+		if start_time > now:
+			sleep(start_time - now)
+
 def check_and_convert_to_wav(input_file):
 	if input_file.lower().endswith('.wav'):
 		return input_file
@@ -42,36 +78,149 @@ def check_and_convert_to_wav(input_file):
 	logging.info("converting to wav...")
 	output_wav_file = os.path.join(TEMP_DIR, 'converted.wav')
 	command = f'ffmpeg -i "{input_file}" -hide_banner -loglevel panic "{output_wav_file}"'
-	run_command(command)
+	run_command(command, stage="ffmpeg decode")
 	return output_wav_file
 
 def get_segment_name(segment_index, segment_duration, skip_duration):
-	start_time = segment_index * (segment_duration + skip_duration)
+	return get_time_name(segment_index * (segment_duration + skip_duration))
+
+def get_time_name(start_time):
 	hours = int(start_time / 3600)
 	minutes = int((start_time % 3600) / 60)
 	seconds = int(start_time % 60)
 	return f'{hours:02d}_{minutes:02d}_{seconds:02d}'
 
-def print_summary(results, occurrences, time_window):
-	printed_titles = set()
+class TitleWindow:
+	# results of one title (in timestamp order) and the two pointers of the sliding time window around the candidate
+	def __init__(self):
+		self.results = []
+		self.candidate = 0 # the earliest timestamp that can still confirm the title
+		self.low = 0 # first timestamp >= candidate - time window
+		self.high = 0 # first timestamp > candidate + time window
+		self.confirmed = False
+
+class TracklistAggregator:
+	# A title goes into the tracklist at its first timestamp that has at least `occurrences` results of the same title
+	# within +-time_window. Results have to be added in timestamp order, so every pointer only moves forward (linear time),
+	# and a title is confirmed as soon as the results allow it, while the mix is still being processed.
+	def __init__(self, occurrences, time_window):
+		self.occurrences = occurrences
+		self.time_window = time_window
+		self.titles = {}
+		self.tracklist = []
+
+	def add(self, result_obj):
+		# returns the Result the title got confirmed at by this result, or None
+		window = self.titles.setdefault(result_obj.title, TitleWindow())
+		window.results.append(result_obj)
+		if window.confirmed:
+			return None
+
+		results = window.results
+		while window.candidate < len(results):
+			candidate_time = results[window.candidate].timestamp
+			while results[window.low].timestamp < candidate_time - self.time_window:
+				window.low += 1
+			while window.high < len(results) and results[window.high].timestamp <= candidate_time + self.time_window:
+				window.high += 1
 
-	summary_lines = []
-	for result_obj in results:
-		title = result_obj.title
-		if title not in printed_titles:
-			count = sum(1 for res in results if res.title == title and abs(res.timestamp - result_obj.timestamp) <= time_window)
-			if count >= occurrences:
-				text_to_print = f'{result_obj.title} @ {result_obj.timestamp}'
-				summary_lines.append(text_to_print)
-				printed_titles.add(title)
+			if window.high - window.low >= self.occurrences:
+				window.confirmed = True
+				confirmed = results[window.candidate]
+				self.tracklist.append(confirmed)
+				self.tracklist.sort(key=lambda track: track.timestamp) # a title can be confirmed at an earlier time than the previous one
+				return confirmed
+			if window.high == len(results):
+				return None # later results of the title can still fall into the candidate's window
+			window.candidate += 1 # the window is complete and not enough, try the next timestamp
+
+		return None
+
+def print_summary(tracklist):
+	summary_lines = [f'{result_obj.title} @ {result_obj.timestamp}' for result_obj in tracklist]
 
 	print("\n----------")
 	print("\n".join(summary_lines))
 	print("\nThis is an automatically generated tracklist. Please reply with your suggestions and corrections.")
 	print("----------")
 
-def process_wav_data(input_file, output_dir, segment_duration, skip_duration, occurrences, time_window):
-	logging.info("processing...")
+def recognize(segment_file, recognizer, limiter, retries):
+	# the recognizer's JSON output, None if it kept failing
+	command = recognizer.format(file=segment_file)
+	for attempt in range(retries + 1):
+		if attempt > 0:
+			delay = RETRY_BACKOFF * 2 ** (attempt - 1)
+			logging.warning(f"retrying {os.path.basename(segment_file)} in {delay}s ({attempt}/{retries})")
+			sleep(delay)
+		limiter.wait()
+		result = try_command(command, stage="recognizer")
+		if result.returncode != 0:
+			logging.warning(f"recognizer failed on {os.path.basename(segment_file)}: {result.stderr.strip()}")
+			continue
+		try:
+			return json.loads(result.stdout)
+		except json.JSONDecodeError:
+			logging.warning(f"invalid recognizer output on {os.path.basename(segment_file)}: {result.stdout.strip()[:200]}")
+
+	logging.error(f"giving up on {os.path.basename(segment_file)}")
+	PROFILER.count("failed segments")
+	return None
+
+def get_cache_params(start_time, args):
+	# a segment's recognition is cached by the input file's identity (ResultCache) and these
+	return {
+		"kind": "recognition",
+		"start": start_time,
+		"duration": args.segment_duration,
+		"extraction": args.extraction,
+		"recognizer": args.recognizer,
+	}
+
+def get_cached_recognition(start_time, args):
+	if CACHE is None:
+		return None
+	return CACHE.get(args.input_file, get_cache_params(start_time, args))
+
+def get_result(result_data, segment_name):
+	# Result of the recognizer's output, None if nothing was recognized
+	if result_data is None or "track" not in result_data:
+		return None
+
+	title = ' - '.join(part for part in [result_data["track"]["subtitle"], result_data["track"]["title"]] if part)
+	result_obj = Result(title, segment_name)
+	PROFILER.count("recognized segments")
+	logging.info(f"found {result_obj}")
+	return result_obj
+
+def match_locally(segment_file):
+	# the segment looked up in the local fingerprint index, in the recognizer's format, None if it is not in the library
+	match = FINGERPRINT_INDEX.match_file(segment_file)
+	if match is None:
+		return None
+	title, position, matching_landmarks = match
+	PROFILER.count("local matches")
+	logging.debug(f"local match: {title} @ {position:.1f}s ({matching_landmarks} landmarks)")
+	return {"track": {"subtitle": "", "title": title}, "local_match": {"position": position, "landmarks": matching_landmarks}}
+
+def recognize_segment(segment_file, segment_name, start_time, args):
+	if FINGERPRINT_INDEX is not None:
+		result_data = match_locally(segment_file)
+		if result_data is not None:
+			if not DEBUG:
+				os.remove(segment_file)
+			return get_result(result_data, segment_name) # not cached, the lookup is cheap and the index can change
+	result_data = recognize(segment_file, args.recognizer, LIMITER, args.retries)
+	if not DEBUG:
+		os.remove(segment_file) # only keep the segments for debugging
+	if result_data is not None and CACHE is not None:
+		CACHE.put(args.input_file, get_cache_params(start_time, args), result_data)
+		CACHE.flush() # a rerun after a crash continues from here
+	return get_result(result_data, segment_name)
+
+def iter_wav_segments(input_file, segment_dir, args):
+	# cuts the segments out of a wav file (in this thread, one at a time, as the recognition workers ask for them)
+	segment_duration = args.segment_duration
+	skip_duration = args.skip_duration
 	with wave.open(input_file, 'rb') as wav_file:
 		# Get the parameters of the input file
 		num_channels = wav_file.getnchannels()
@@ -86,52 +235,218 @@ def process_wav_data(input_file, output_dir, segment_duration, skip_duration, oc
 		# Split the WAV file into segments
 		segment_count = 0
 		start_frame = 0
-		allResults = []
 
 		while start_frame < total_frames:
-			# Calculate the end frame for the current segment
-			end_frame = start_frame + segment_frames
+			start_time = segment_count * (segment_duration + skip_duration)
+			segment_name = get_segment_name(segment_count, segment_duration, skip_duration)
+			PROFILER.count("segments")
+			logging.info(segment_name)
 
-			# Set the position in the input file
-			wav_file.setpos(start_frame)
+			cached_data = get_cached_recognition(start_time, args)
+			if cached_data is not None:
+				yield (get_result, cached_data, segment_name)
+			else:
+				with PROFILER.stage("segment extraction"):
+					# Set the position in the input file
+					wav_file.setpos(start_frame)
 
-			# Read frames for the current segment
-			frames = wav_file.readframes(segment_frames)
+					# Read frames for the current segment
+					frames = wav_file.readframes(segment_frames)
 
-			# Create a new output WAV file
-			segment_name = get_segment_name(segment_count, segment_duration, skip_duration)
-			segment_filename = f'segment_{segment_name}.wav'
-			output_file = os.path.join(output_dir, segment_filename)
-			with wave.open(output_file, 'wb') as output_wav:
-				# Set the output file parameters
-				output_wav.setnchannels(num_channels)
-				output_wav.setsampwidth(sample_width)
-				output_wav.setframerate(frame_rate)
-				output_wav.writeframes(frames)
-
-			if not os.path.isfile(output_file):	
-				logging.error(f"Failed to create segment {output_file}")
-				sys.exit(1)
-
-			result = None
-			logging.info(segment_name)
-			#sleep(3) # weird outputs from songrec ?
-			result = run_command(f'songrec audio-file-to-recognized-song "{output_file}"')
+					# Create a new output WAV file
+					segment_filename = f'segment_{segment_name}.wav'
+					output_file = os.path.join(segment_dir, segment_filename)
+					with wave.open(output_file, 'wb') as output_wav:
+						# Set the output file parameters
+						output_wav.setnchannels(num_channels)
+						output_wav.setsampwidth(sample_width)
+						output_wav.setframerate(frame_rate)
+						output_wav.writeframes(frames)
+
+				if not os.path.isfile(output_file):	
+					logging.error(f"Failed to create segment {output_file}")
+					sys.exit(1)
 
-			result_data = json.loads(result)
-			if "track" in result_data:
-				title = result_data["track"]["subtitle"] + ' - ' + result_data["track"]["title"]
-				result_obj = Result(title, segment_name)
-				allResults.append(result_obj)
-				logging.info(f"found {result_obj}")
+				yield (recognize_segment, output_file, segment_name, start_time, args)
 
 			segment_count += 1
 			start_frame += segment_frames + skip_frames
 
-		print_summary(allResults, occurrences, time_window)
+def extract_segment(input_file, start_time, duration, output_file):
+	# input seeking: ffmpeg only decodes this part of the original (compressed) file
+	# mono 16 kHz is enough, the recognizer resamples to that anyway
+	command = f'ffmpeg -nostdin -hide_banner -loglevel error -y -ss {start_time} -t {duration} -i "{input_file}" -map 0:a:0 -ac 1 -ar {SEGMENT_SAMPLE_RATE} -acodec pcm_s16le "{output_file}"'
+	run_command(command, stage="segment extraction")
+	if not os.path.isfile(output_file):
+		logging.error(f"Failed to create segment {output_file}")
+		sys.exit(1)
+
+def extract_and_recognize_segment(input_file, output_file, segment_name, start_time, args):
+	extract_segment(input_file, start_time, args.segment_duration, output_file)
+	return recognize_segment(output_file, segment_name, start_time, args)
+
+def iter_seek_segments(input_file, segment_dir, args):
+	# the segments are cut from the original file by the recognition workers themselves, no full-mix wav is made
+	duration = get_audio_info(input_file)[0]
+	segment_count = 0
+	while segment_count * (args.segment_duration + args.skip_duration) < duration:
+		start_time = segment_count * (args.segment_duration + args.skip_duration)
+		segment_name = get_segment_name(segment_count, args.segment_duration, args.skip_duration)
+		PROFILER.count("segments")
+		logging.info(segment_name)
+
+		yield get_seek_job(input_file, segment_dir, start_time, segment_name, args)
+		segment_count += 1
+
+def get_seek_job(input_file, segment_dir, start_time, segment_name, args):
+	# (func, *func_args) that results in the segment's Result, from the cache if possible
+	cached_data = get_cached_recognition(start_time, args)
+	if cached_data is not None:
+		return (get_result, cached_data, segment_name)
+	output_file = os.path.join(segment_dir, f'segment_{segment_name}.wav')
+	return (extract_and_recognize_segment, input_file, output_file, segment_name, start_time, args)
+
+def get_band_energies(input_file):
+	# log energies of NOVELTY_BANDS bands for every second of the mix, from one low-rate mono decode streamed through a pipe
+	import numpy as np
+	frame_samples = NOVELTY_SAMPLE_RATE
+	hzs = np.fft.rfftfreq(frame_samples, 1 / NOVELTY_SAMPLE_RATE)
+	band_edges = np.geomspace(NOVELTY_MIN_HZ, NOVELTY_SAMPLE_RATE / 2, NOVELTY_BANDS + 1)
+	band_of_bin = np.digitize(hzs, band_edges) - 1
+	band_matrix = (band_of_bin[:, None] == np.arange(NOVELTY_BANDS)[None, :]).astype(np.float32) # bins x bands, sums the bins of every band
+	window = np.hanning(frame_samples).astype(np.float32)
+
+	command = f'ffmpeg -nostdin -hide_banner -loglevel error -i "{input_file}" -map 0:a:0 -ac 1 -ar {NOVELTY_SAMPLE_RATE} -f s16le -acodec pcm_s16le -'
+	frame_bytes = frame_samples * 2
+	energies = []
+	for raw in iter_ffmpeg_pcm(command, frame_bytes, frame_bytes * NOVELTY_FRAMES_PER_READ):
+		frames = np.frombuffer(raw, dtype='<i2').astype(np.float32).reshape(-1, frame_samples) / 2. ** 15
+		spectrum = np.fft.rfft(frames * window, axis=1)
+		energies.append(np.log10((spectrum.real ** 2 + spectrum.imag ** 2) @ band_matrix + 1e-10))
+	return np.concatenate(energies) if len(energies) > 0 else np.zeros((0, NOVELTY_BANDS), dtype=np.float32)
+
+def get_transitions(energies):
+	# seconds where the sound changes the most: the distance of the mean band energies of the NOVELTY_CONTEXT seconds before
+	# and after every second, the peaks above median + std that are at least MIN_TRANSITION_GAP apart
+	import numpy as np
+	context = NOVELTY_CONTEXT
+	if len(energies) < 2 * context + 1:
+		return []
+	sums = np.vstack([np.zeros((1, energies.shape[1])), np.cumsum(energies, axis=0, dtype=np.float64)])
+	times = np.arange(context, len(energies) - context + 1)
+	before = (sums[times] - sums[times - context]) / context
+	after = (sums[times + context] - sums[times]) / context
+	novelty = np.linalg.norm(after - before, axis=1)
+	threshold = np.median(novelty) + np.std(novelty)
+
+	transitions = []
+	for index in np.argsort(novelty)[::-1]:
+		if novelty[index] <= threshold:
+			break
+		if all(abs(times[index] - transition) >= MIN_TRANSITION_GAP for transition in transitions):
+			transitions.append(int(times[index]))
+	return sorted(transitions)
+
+def get_region_probes(region_start, region_end, args):
+	# probe start times of a region (whole seconds): one shortly after the transition, then on the usual segment + skip steps
+	# a region shorter than a segment still gets a probe in its middle, so short tracks are not skipped
+	step = args.segment_duration + args.skip_duration
+	first_probe = region_start + TRANSITION_MARGIN
+	if first_probe + args.segment_duration > region_end:
+		return [max(int((region_start + region_end - args.segment_duration) / 2), 0)]
+	probes = []
+	while first_probe + len(probes) * step + args.segment_duration <= region_end:
+		probes.append(int(first_probe + len(probes) * step))
+	return probes
+
+def recognize_adaptive(input_file, segment_dir, args):
+	# Probes every region between two detected transitions, from its start, with at most --occurrences recognitions
+	# running per region, and stops probing a region once a title got --occurrences hits in it. Returns the tracklist.
+	duration = get_audio_info(input_file)[0]
+	with PROFILER.stage("novelty analysis"):
+		transitions = get_transitions(get_band_energies(input_file))
+	boundaries = [0] + transitions + [duration]
+	regions = [collections.deque(get_region_probes(start, end, args)) for start, end in zip(boundaries[:-1], boundaries[1:])]
+	logging.info(f"{len(transitions)} transitions found: {', '.join(get_time_name(t) for t in transitions)}")
+
+	region_titles = [collections.Counter() for _ in regions]
+	region_running = [0] * len(regions)
+	region_done = [False] * len(regions)
+	workers = max(args.workers, 1)
+	executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+	running = {} # future -> region index
+	results = []
+	probe_count = 0
+	while True:
+		# start probes, the earlier regions first
+		for region_index, probes in enumerate(regions):
+			while len(running) < workers and not region_done[region_index] and len(probes) > 0 and region_running[region_index] < args.occurrences:
+				start_time = probes.popleft()
+				segment_name = get_time_name(start_time)
+				PROFILER.count("segments")
+				logging.info(segment_name)
+				func, *func_args = get_seek_job(input_file, segment_dir, start_time, segment_name, args)
+				running[executor.submit(func, *func_args)] = region_index
+				region_running[region_index] += 1
+				probe_count += 1
+		if len(running) == 0:
+			break
+
+		done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+		for future in done:
+			region_index = running.pop(future)
+			region_running[region_index] -= 1
+			result_obj = future.result()
+			if result_obj is None:
+				continue
+			results.append(result_obj)
+			region_titles[region_index][result_obj.title] += 1
+			if region_titles[region_index][result_obj.title] >= args.occurrences and not region_done[region_index]:
+				region_done[region_index] = True
+				logging.debug(f"region {region_index} confirmed as {result_obj.title}, {len(regions[region_index])} probes skipped")
+	executor.shutdown()
+
+	grid_count = math.ceil(duration / (args.segment_duration + args.skip_duration))
+	logging.info(f"probes: {probe_count}, the fixed grid would need {grid_count} ({grid_count - probe_count} recognizer calls saved)")
+	PROFILER.count("probes saved", grid_count - probe_count)
+
+	aggregator = TracklistAggregator(args.occurrences, timedelta(minutes=args.time_window))
+	for result_obj in sorted(results, key=lambda result_obj: result_obj.timestamp):
+		aggregator.add(result_obj)
+	return aggregator.tracklist
+
+def add_result(aggregator, result_obj):
+	if result_obj is None:
+		return
+	confirmed = aggregator.add(result_obj)
+	if confirmed is not None:
+		logging.info(f"tracklist ({len(aggregator.tracklist)}): {confirmed}")
+
+def recognize_segments(segments, args):
+	# runs the (func, *func_args) jobs of the segments on the recognition workers and returns the tracklist
+	# the results are aggregated in segment (= timestamp) order, as they come in
+	aggregator = TracklistAggregator(args.occurrences, timedelta(minutes=args.time_window))
+	workers = max(args.workers, 1)
+	executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+	pending = collections.deque() # recognitions in segment order
+	for func, *func_args in segments:
+		pending.append(executor.submit(func, *func_args))
+		# don't cut the whole mix ahead of the workers
+		while len(pending) >= workers * SEGMENTS_PER_WORKER:
+			add_result(aggregator, pending.popleft().result())
+
+	for future in pending:
+		add_result(aggregator, future.result())
+	executor.shutdown()
+	return aggregator.tracklist
+
+def get_segment_dir():
+	# a fresh folder for the segments of this run, in memory (tmpfs) if possible
+	base_dir = SHM_DIR if os.path.isdir(SHM_DIR) and os.access(SHM_DIR, os.W_OK) else tempfile.gettempdir()
+	return tempfile.mkdtemp(prefix="mixdetect_segments_", dir=base_dir)
 
 def main():
-	global DEBUG
+	global DEBUG, CACHE, LIMITER, FINGERPRINT_INDEX
 
 	# parse arguments
 	parser = argparse.ArgumentParser(description='Detects the track IDs from a DJ mix using SongRec (Shazam)')
@@ -140,8 +455,19 @@ def main():
 	parser.add_argument('--skip-duration', type=float, default=15, help='duration to skip between segments in seconds (default: 15)')
 	parser.add_argument('--occurrences', type=int, default=2, help='minimum number of occurrences for a result to be printed (default: 2)')
 	parser.add_argument('--time-window', type=int, default=5, help='time window in minutes to consider for occurrences (default: 5)')
-	parser.add_argument('--debug', action='store_true', help=f'Enabled debug mode.')
+	parser.add_argument('--workers', type=int, default=4, help='number of parallel recognitions (default: 4)')
+	parser.add_argument('--requests-per-second', type=float, default=1, help='max number of recognizer calls started per second, 0 for no limit (default: 1)')
+	parser.add_argument('--retries', type=int, default=3, help=f'retry a failed recognition this many times, waiting {RETRY_BACKOFF}s, then twice as long every time (default: 3)')
+	parser.add_argument('--recognizer', type=str, default=DEFAULT_RECOGNIZER, help=f'recognizer command, {{file}} is replaced with the segment wav, it has to print songrec\'s JSON (default: {DEFAULT_RECOGNIZER})')
+	parser.add_argument('--extraction', type=str, default='seek', choices=['seek', 'wav'], help='seek: ffmpeg cuts every segment straight from the input file, wav: convert the whole input to one wav first, then cut that (default: seek)')
+	parser.add_argument('--schedule', type=str, default='grid', choices=['grid', 'adaptive'], help='grid: a segment every segment + skip duration, adaptive: find the transitions locally first, probe between them on the same grid and stop once a title is confirmed --occurrences times (needs --extraction seek) (default: grid)')
+	parser.add_argument('--fingerprint-index', type=str, default=None, help='look the segments up in this local fingerprint index (see fingerprint.py) first, only the misses are sent to the recognizer')
+	parser.add_argument('--cache', type=str, default=None, help=f'recognition cache file, reruns (e.g. with other --occurrences or --time-window values) only recognize the missing segments (default: {CACHE_FILE_NAME} next to the input file)')
+	parser.add_argument('--no-cache', action='store_true', help='do not read or write the recognition cache')
+	parser.add_argument('--debug', action='store_true', help=f'Enabled debug mode, keeps the segment files.')
+	add_profile_arguments(parser)
 	args = parser.parse_args()
+	profile_start = start_profiling(args)
 	
 	# init
 	DEBUG = args.debug
@@ -152,10 +478,38 @@ def main():
 		logging.error('The input file does not exist.')
 		sys.exit(1)
 
+	if args.schedule == 'adaptive' and args.extraction != 'seek':
+		logging.error('--schedule adaptive needs --extraction seek')
+		sys.exit(1)
+
 	# run it
-	input_file = check_and_convert_to_wav(args.input_file)
-	time_window = timedelta(minutes=args.time_window)
-	process_wav_data(input_file, TEMP_DIR, args.segment_duration, args.skip_duration, args.occurrences, time_window)
+	if not args.no_cache:
+		CACHE = ResultCache(args.cache if args.cache is not None else os.path.join(os.path.dirname(os.path.abspath(args.input_file)), CACHE_FILE_NAME))
+	LIMITER = RateLimiter(args.requests_per_second)
+	if args.fingerprint_index is not None:
+		from fingerprint import FingerprintIndex # numpy & scipy are only needed with an index
+		FINGERPRINT_INDEX = FingerprintIndex(args.fingerprint_index)
+	logging.info("processing...")
+	segment_dir = get_segment_dir()
+	try:
+		if args.schedule == 'adaptive':
+			tracklist = recognize_adaptive(args.input_file, segment_dir, args)
+		else:
+			if args.extraction == 'seek':
+				segments = iter_seek_segments(args.input_file, segment_dir, args)
+			else:
+				segments = iter_wav_segments(check_and_convert_to_wav(args.input_file), segment_dir, args)
+			tracklist = recognize_segments(segments, args)
+	finally:
+		if DEBUG:
+			logging.debug(f"segments kept in {segment_dir}")
+		else:
+			shutil.rmtree(segment_dir, ignore_errors=True)
+		if CACHE is not None:
+			CACHE.close()
+			logging.info(f"cache hits: {CACHE.hits}, misses: {CACHE.misses}")
+	print_summary(tracklist)
+	finish_profiling(args, profile_start)
 
 if __name__ == '__main__':
 	main()
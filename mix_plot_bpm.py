@@ -1,24 +1,32 @@
-import array
 import math
 import wave
 import subprocess
-import matplotlib.pyplot as plt
+# matplotlib, pywt and scipy are imported where they are used, so --help and the folder mode without plots start fast
 import numpy
-import pywt
-from scipy import signal
 import sys
 import os
 import argparse
+import collections
+import concurrent.futures
+import csv
+import json
 import shutil
 import subprocess
 import tempfile
 
+from utils import *
+
+WINDOWS_PER_WORKER = 4 # windows read ahead per worker in the --hop mode
+INDEX_FILE_NAME = ".mix_plot_bpm_index.sqlite"
+FOLDER_ANALYSIS_RATE = 11025 # folder mode always pipes, a full-size temporary wav per worker would fill /tmp
+INDEX_VERSION = 1 # bump when the timeline calculation changes, old index entries are ignored then
+
 def convertToWav(input_file, output_dir):
 	print("converting to wav...")
 	temp_dir = tempfile.mkdtemp(dir=output_dir)
 	output_file = os.path.join(temp_dir, "output.wav")
 	ffmpeg_command = f'ffmpeg -loglevel quiet -n -i "{input_file}" "{output_file}"'
-	subprocess.call(ffmpeg_command, shell=True)
+	run_command(ffmpeg_command, stage="ffmpeg decode")
 	return output_file
 
 
@@ -29,24 +37,48 @@ def formatSeconds(seconds):
 	seconds %= 60
 	return "%02i:%02i:%02i" % (hours, minutes, seconds)
 
-def read_wav(filename, startSecond, endSecond):
+def read_wav(filename, startSecond, endSecond, rate=None):
+	# [mono samples, fs], straight from the wav, or decoded by ffmpeg at the given rate if one is given
+	if rate is not None:
+		return [decodeSamples(filename, startSecond, endSecond, rate), rate]
+	with PROFILER.stage("read wav"):
+		return read_wav_samples(filename, startSecond, endSecond)
+
+def getDecodeCommand(filename, rate, startSecond=None, duration=None):
+	# ffmpeg writing mono 16-bit samples at the given rate to stdout, the tempo detection doesn't need more bandwidth than that
+	seek = f"-ss {startSecond} -t {duration} " if startSecond is not None else ""
+	return f'ffmpeg -nostdin -loglevel error {seek}-i "{filename}" -map 0:a:0 -ac 1 -ar {rate} -f s16le -acodec pcm_s16le -'
+
+def decodeSamples(filename, startSecond, endSecond, rate):
+	raw = run_command_bytes(getDecodeCommand(filename, rate, startSecond, endSecond - startSecond), stage="ffmpeg decode")
+	return pcm_to_mono(raw, 2, 1)
+
+def pcm_to_mono(raw, sample_width, num_channels):
+	# interleaved little-endian PCM bytes (as the wave module returns them) to mono float32 samples in [-1, 1)
+	samps = pcm_to_float(raw, sample_width)
+	if num_channels == 1:
+		return samps
+	return samps.reshape(-1, num_channels).mean(axis=1, dtype=numpy.float32)
+
+def read_wav_samples(filename, startSecond, endSecond):
 	try:
-		wf = wave.open(filename, "rb")
-		nsamps = wf.getnframes()
-		fs = wf.getframerate()
+		with wave.open(filename, "rb") as wf:
+			nsamps = wf.getnframes()
+			fs = wf.getframerate()
 
-		if nsamps == 0 or fs == 0:
-			print(f"[E] while getting basic wav data")
-			sys.exit(1)
+			if nsamps == 0 or fs == 0:
+				print(f"[E] while getting basic wav data")
+				sys.exit(1)
 
-		startSample = fs * startSecond
-		endSample = fs * endSecond
-		samplesToRead = endSample - startSample
-		wf.setpos(startSample)
-		samps = list(array.array("i", wf.readframes(samplesToRead)))
+			startSample = min(int(fs * startSecond), nsamps)
+			endSample = min(int(fs * endSecond), nsamps)
+			samplesToRead = endSample - startSample
+			wf.setpos(startSample)
+			samps = pcm_to_mono(wf.readframes(samplesToRead), wf.getsampwidth(), wf.getnchannels())
 
 	except Exception as error:
 		print(f"[E] error while reading samples: {error}")
+		sys.exit(1)
 
 	return [samps, fs]
 
@@ -59,7 +91,17 @@ def peak_detect(data):
 
 	return peak_ndx
 
+def autocorrelate(data, max_lag):
+	# sum(data[i + lag] * data[i]) for lag in [0, max_lag), the lag >= 0 half of numpy.correlate(data, data, "full")
+	# computed with a real FFT, zero padded just enough so that no lag below max_lag wraps around
+	from scipy.fft import irfft, next_fast_len, rfft
+	size = next_fast_len(len(data) + max_lag, real=True)
+	spectrum = rfft(data, size)
+	return irfft(spectrum.real ** 2 + spectrum.imag ** 2, size)[:min(max_lag, len(data))]
+
 def calculateBpm(data, fs):
+	import pywt
+	from scipy import signal
 	cA = []
 	cD = []
 	correl = []
@@ -69,39 +111,40 @@ def calculateBpm(data, fs):
 	min_ndx = math.floor(60.0 / 220 * (fs / max_decimation))
 	max_ndx = math.floor(60.0 / 40 * (fs / max_decimation))
 
-	for loop in range(0, levels):
-		cD = []
+	PROFILER.count("windows")
+	with PROFILER.stage("dwt"):
+		for loop in range(0, levels):
+			cD = []
 
-		if loop == 0:
-			[cA, cD] = pywt.dwt(data, "db4")
-			cD_minlen = len(cD) / max_decimation + 1
-			cD_sum = numpy.zeros(math.floor(cD_minlen))
-		else:
-			[cA, cD] = pywt.dwt(cA, "db4")
+			if loop == 0:
+				[cA, cD] = pywt.dwt(data, "db4")
+				cD_minlen = len(cD) / max_decimation + 1
+				cD_sum = numpy.zeros(math.floor(cD_minlen))
+			else:
+				[cA, cD] = pywt.dwt(cA, "db4")
 
-		cD = signal.lfilter([0.01], [1 - 0.99], cD)
-		cD = abs(cD[:: (2 ** (levels - loop - 1))])
-		cD = cD - numpy.mean(cD)
-		cD_sum = cD[0 : math.floor(cD_minlen)] + cD_sum
+			cD = signal.lfilter([0.01], [1 - 0.99], cD)
+			cD = abs(cD[:: (2 ** (levels - loop - 1))])
+			cD = cD - numpy.mean(cD)
+			cD_sum = cD[0 : math.floor(cD_minlen)] + cD_sum
 
-	if [b for b in cA if b != 0.0] == []:
+	if not numpy.any(cA):
 		print("[i] No audio data!")
 		return None
 
-	cA = signal.lfilter([0.01], [1 - 0.99], cA)
-	cA = abs(cA)
-	cA = cA - numpy.mean(cA)
-	cD_sum = cA[0 : math.floor(cD_minlen)] + cD_sum
-	correl = numpy.correlate(cD_sum, cD_sum, "full")
-	midpoint = math.floor(len(correl) / 2)
-	correl_midpoint_tmp = correl[midpoint:]
-	peak_ndx = peak_detect(correl_midpoint_tmp[min_ndx:max_ndx])
+	with PROFILER.stage("correlation"):
+		cA = signal.lfilter([0.01], [1 - 0.99], cA)
+		cA = abs(cA)
+		cA = cA - numpy.mean(cA)
+		cD_sum = cA[0 : math.floor(cD_minlen)] + cD_sum
+		correl = autocorrelate(cD_sum, max_ndx) # only the lags that can be a 40-220 bpm beat
+		peak_ndx = peak_detect(correl[min_ndx:max_ndx])
 
 	if len(peak_ndx) > 1:
 		print("[i] No audio data!")
 		return None
 
-	peak_ndx_adjusted = peak_ndx[0] + min_ndx
+	peak_ndx_adjusted = peak_ndx[0][0] + min_ndx
 	bpm = 60.0 / peak_ndx_adjusted * (fs / max_decimation)
 	return [bpm, correl]
 
@@ -135,21 +178,145 @@ def getBpm(samps, fs, windowSize):
 
 	return numpy.median(bpms)
 
+def iterWindows(filename, windowSize, rate=None):
+	# Reads the wav once from start to end and yields [start second, mono samples, fs] for consecutive windows
+	# Only the current window is kept in memory, no matter how long the file is
+	if rate is not None:
+		yield from iterDecodedWindows(filename, windowSize, rate)
+		return
 
+	with wave.open(filename, "rb") as wf:
+		fs = wf.getframerate()
+		window_samps = int(windowSize * fs)
+		position = 0
+		while True:
+			with PROFILER.stage("read wav"):
+				samps = pcm_to_mono(wf.readframes(window_samps), wf.getsampwidth(), wf.getnchannels())
+			if len(samps) < window_samps:
+				return
+			yield [position / fs, samps, fs]
+			position += window_samps
+
+def iterDecodedWindows(filename, windowSize, rate):
+	# Same as iterWindows, but the samples come from an ffmpeg pipe at the given rate (any input format, nothing written to disk)
+	window_bytes = int(windowSize * rate) * 2
+	position = 0
+	for raw in iter_ffmpeg_pcm(getDecodeCommand(filename, rate), 2, window_bytes):
+		if len(raw) < window_bytes:
+			continue # the end of the file, not a full window
+		yield [position / rate, pcm_to_mono(raw, 2, 1), rate]
+		position += window_bytes // 2
+
+def windowBpm(samps, fs):
+	calculatedData = calculateBpm(samps, fs)
+	return None if calculatedData == None else float(calculatedData[0])
+
+def windowBpmShared(shm_name, shape, dtype, row, fs):
+	# windowBpm in a worker process, the windows are passed in shared memory instead of being pickled
+	shm, windows = attach_shared_array(shm_name, shape, dtype)
+	try:
+		return windowBpm(windows[row], fs)
+	finally:
+		del windows
+		shm.close()
+
+def profiledCall(profile, func, *func_args):
+	# func(*func_args) in a pool worker, returns (result, the profiler numbers of this call or None) for mergeProfiles in the parent
+	PROFILER.reset(profile)
+	return func(*func_args), PROFILER.export() if profile else None
+
+def mergeProfiles(results):
+	# the results of profiledCall, their profiler numbers are added to this process' profiler
+	for result, profile in results:
+		if profile is not None:
+			PROFILER.merge(profile)
+		yield result
+
+def iterWindowBpms(filename, window_size, executor, workers, rate=None):
+	# [start second, bpm or None] of every window, in order
+	if executor is None:
+		for start, samps, fs in iterWindows(filename, window_size, rate):
+			yield [start, windowBpm(samps, fs)]
+		return
+
+	# read a chunk of windows, let the pool analyse them from shared memory, repeat
+	chunk_size = workers * WINDOWS_PER_WORKER
+	windows = iterWindows(filename, window_size, rate)
+	while True:
+		chunk = [w for _, w in zip(range(chunk_size), windows)]
+		if len(chunk) == 0:
+			return
+		fs = chunk[0][2]
+		shm = create_shared_array(numpy.stack([samps for _, samps, _ in chunk]))
+		try:
+			shape = (len(chunk), len(chunk[0][1]))
+			bpms = list(mergeProfiles(executor.map(profiledCall, [PROFILER.enabled] * len(chunk), [windowBpmShared] * len(chunk), [shm.name] * len(chunk), [shape] * len(chunk), [numpy.dtype(numpy.float32).str] * len(chunk), range(len(chunk)), [fs] * len(chunk))))
+		finally:
+			shm.close()
+			shm.unlink()
+		for (start, _, _), bpm in zip(chunk, bpms):
+			yield [start, bpm]
+
+def streamBpm(filename, sample_length, window_size, hop, executor=None, workers=1, rate=None):
+	# Single pass BPM timeline: every window_size window is analysed exactly once,
+	# each point (every hop seconds) is the median of the windows in the last sample_length seconds
+	windows_per_point = max(round(sample_length / window_size), 1)
+	windows_per_hop = max(round(hop / window_size), 1)
+	recent = collections.deque(maxlen=windows_per_point)
+
+	for window_ndx, (start, bpm) in enumerate(iterWindowBpms(filename, window_size, executor, workers, rate)):
+		recent.append(bpm)
+		if len(recent) < windows_per_point or (window_ndx + 1 - windows_per_point) % windows_per_hop != 0:
+			continue
 
+		valid_bpms = [bpm for bpm in recent if bpm is not None]
+		point_start = start + window_size - windows_per_point * window_size
+		yield [point_start, point_start + windows_per_point * window_size, float(numpy.median(valid_bpms)) if valid_bpms else 0.0]
 
-def plotBpm(filename, num_samples, sample_length, window_size, min_bpm, max_bpm):
-	fileLength = int(float(subprocess.check_output("ffprobe -v error -show_entries format=duration -of default=noprint_wrappers=1:nokey=1 '" + filename + "'", shell=True).decode('utf-8').strip()))
-	sampleRate = read_wav(filename, 0, 1)[1]
+def drawBpm(timeData, bpmData):
+	import matplotlib.pyplot as plt
+	plt.plot(timeData, bpmData)
+	plt.xlabel("Time")
+	plt.ylabel("BPM")
+	if len(bpmData) > 0:
+		plt.ylim(min(bpmData) - 0.5, max(bpmData) + 0.5)
+	plt.grid(axis='y')
+	plt.xticks(rotation=45)
+
+def plotBpmTimeline(filename, sample_length, window_size, hop, min_bpm, max_bpm, executor=None, workers=1, rate=None):
+	bpmData = []
+	timeData = []
+	print(f"{filename}: full timeline, a point every {hop}s")
+
+	for startTime, endTime, currentBpm in streamBpm(filename, sample_length, window_size, hop, executor, workers, rate):
+		if min_bpm < currentBpm < max_bpm:
+			bpmData.append(currentBpm)
+			timeData.append(formatSeconds(startTime))
+			print(f"{startTime:7.1f}s -> {endTime:7.1f}s: {round(currentBpm, 5):6} bpm")
+		else:
+			print(f"{startTime:7.1f}s -> {endTime:7.1f}s: {round(currentBpm, 5):6} bpm <- SKIPPING")
+
+	drawBpm(timeData, bpmData)
+
+def getProbeBpm(filename, startTime, sample_length, sampleRate, window_size, rate=None):
+	wavData = read_wav(filename, startTime, startTime + sample_length, rate)
+	return getBpm(wavData[0], sampleRate, window_size)
+
+def plotBpm(filename, num_samples, sample_length, window_size, min_bpm, max_bpm, executor=None, rate=None):
+	fileLength = int(float(run_command("ffprobe -v error -show_entries format=duration -of default=noprint_wrappers=1:nokey=1 '" + filename + "'", stage="ffprobe").strip()))
+	sampleRate = rate if rate is not None else read_wav(filename, 0, 1)[1]
 
 	bpmData = []
 	timeData = []
 	print(f"{filename}: {fileLength}s at {sampleRate}hz")
 
-	for i in range(0, fileLength, int(fileLength / num_samples)):
+	# every probe reads its own part of the file, so the pool workers just get the file name
+	probes = list(range(0, fileLength, int(fileLength / num_samples)))
+	probe_args = [[filename] * len(probes), probes, [sample_length] * len(probes), [sampleRate] * len(probes), [window_size] * len(probes), [rate] * len(probes)]
+	probeBpms = mergeProfiles(executor.map(profiledCall, [PROFILER.enabled] * len(probes), [getProbeBpm] * len(probes), *probe_args)) if executor is not None else map(getProbeBpm, *probe_args)
+
+	for i, currentBpm in zip(probes, probeBpms):
 		endTime = i + sample_length
-		wavData = read_wav(filename, i, endTime)
-		currentBpm = getBpm(wavData[0], sampleRate, window_size)
 		if min_bpm < currentBpm < max_bpm:
 			bpmData.append(currentBpm)
 			timeData.append(formatSeconds(i))
@@ -157,36 +324,160 @@ def plotBpm(filename, num_samples, sample_length, window_size, min_bpm, max_bpm)
 		else:
 			print(f"{i:5}s -> {endTime:5}s: {round(currentBpm, 5):6} bpm <- SKIPPING")
 
-	plt.plot(timeData, bpmData)
-	plt.xlabel("Time")
-	plt.ylabel("BPM")
-	plt.ylim(min(bpmData) - 0.5, max(bpmData) + 0.5)
-	plt.grid(axis='y')
-	plt.xticks(rotation=45)
-	plt.show()
+	drawBpm(timeData, bpmData)
 
+def analyzeFile(filename, args):
+	executor = concurrent.futures.ProcessPoolExecutor(max_workers=args.workers) if args.workers > 1 else None
+	try:
+		if args.hop is not None:
+			plotBpmTimeline(filename, args.length, args.window, args.hop, args.min_bpm, args.max_bpm, executor, args.workers, args.analysis_rate)
+		else:
+			plotBpm(filename, args.samples, args.length, args.window, args.min_bpm, args.max_bpm, executor, args.analysis_rate)
+	finally:
+		if executor is not None:
+			executor.shutdown()
+
+
+def getTimeline(filename, args):
+	# [[start second, end second, bpm], ...] of the whole mix, decoded by ffmpeg at --analysis-rate straight into the analysis
+	hop = args.hop if args.hop is not None else args.length
+	return list(streamBpm(filename, args.length, args.window, hop, rate=args.analysis_rate))
+
+def getIndexParams(args):
+	# everything that changes the stored timelines, the bpm limits only filter the output
+	return {
+		"version": INDEX_VERSION,
+		"length": args.length,
+		"window": args.window,
+		"hop": args.hop if args.hop is not None else args.length,
+		"analysis_rate": args.analysis_rate,
+	}
+
+def saveTimelinePlot(filename, folder, timeline, min_bpm, max_bpm, plot_dir):
+	import matplotlib.pyplot as plt
+	points = [[start, bpm] for start, _, bpm in timeline if min_bpm < bpm < max_bpm]
+	plt.figure(figsize=(12, 4))
+	drawBpm([formatSeconds(start) for start, _ in points], [bpm for _, bpm in points])
+	plt.title(os.path.basename(filename))
+	plt.tight_layout()
+	plot_name = os.path.splitext(os.path.relpath(filename, folder))[0].replace(os.sep, "_") + ".png" # mixes with the same name can be in different subfolders
+	plt.savefig(os.path.join(plot_dir, plot_name))
+	plt.close()
+
+def exportTimelines(timelines, json_path, csv_path):
+	if json_path is not None:
+		with open(json_path, "w") as f:
+			json.dump({filename: [{"start": start, "end": end, "bpm": bpm} for start, end, bpm in timeline] for filename, timeline in timelines.items()}, f, indent=1)
+		print(f"timelines written to {json_path}")
+	if csv_path is not None:
+		with open(csv_path, "w", newline="") as f:
+			writer = csv.writer(f)
+			writer.writerow(["file", "start", "end", "bpm"])
+			for filename, timeline in timelines.items():
+				for start, end, bpm in timeline:
+					writer.writerow([filename, start, end, bpm])
+		print(f"timelines written to {csv_path}")
+
+def indexFolder(args):
+	# Headless batch mode: BPM timeline of every mix in the folder, one mix per worker process,
+	# stored in a persistent index (keyed by path + size + mtime), so a rerun only analyses new or changed files
+	file_list = sorted(f for f in get_files_recursive(args.filename) if is_audio_format(f))
+	if args.analysis_rate is None:
+		args.analysis_rate = FOLDER_ANALYSIS_RATE
+	index = ResultCache(args.index if args.index is not None else os.path.join(args.filename, INDEX_FILE_NAME))
+	params = getIndexParams(args)
+	print(f"found {len(file_list)} mixes")
+
+	timelines = {}
+	todo = []
+	for filename in file_list:
+		timeline = index.get(filename, params)
+		if timeline is None:
+			todo.append(filename)
+		else:
+			timelines[filename] = timeline
+	print(f"{len(timelines)} mixes already indexed, analysing {len(todo)}")
+
+	executor = concurrent.futures.ProcessPoolExecutor(max_workers=args.workers) if args.workers > 1 else None
+	try:
+		if executor is not None:
+			futures = {executor.submit(profiledCall, PROFILER.enabled, getTimeline, filename, args): filename for filename in todo}
+			done = ((futures[future], future) for future in concurrent.futures.as_completed(futures))
+		else:
+			done = ((filename, None) for filename in todo)
+
+		for count, (filename, future) in enumerate(done, 1):
+			try:
+				if future is not None:
+					[timeline] = mergeProfiles([future.result()])
+				else:
+					timeline = getTimeline(filename, args)
+			except SystemExit:
+				print(f"[E] {filename}: analysis failed, skipping")
+				continue
+			except Exception as error:
+				print(f"[E] {filename}: {error}")
+				continue
+			PROFILER.count("mixes")
+			timelines[filename] = timeline
+			index.put(filename, params, timeline)
+			index.flush() # every mix is minutes of work, don't lose it on ctrl+c
+			print(f"[{count}/{len(todo)}] {filename}: {len(timeline)} points")
+	finally:
+		if executor is not None:
+			executor.shutdown(cancel_futures=True)
+		index.close()
+
+	timelines = {filename: timelines[filename] for filename in file_list if filename in timelines}
+	exportTimelines(timelines, args.export_json, args.export_csv)
+	if args.plot_dir is not None:
+		import matplotlib
+		matplotlib.use("agg") # headless, the graphs are only saved
+		os.makedirs(args.plot_dir, exist_ok=True)
+		for filename, timeline in timelines.items():
+			saveTimelinePlot(filename, args.filename, timeline, args.min_bpm, args.max_bpm, args.plot_dir)
+		print(f"plots saved to {args.plot_dir}")
 
 def main():
-	parser = argparse.ArgumentParser(description="Calculate and plot BPM from an audio file.")
-	parser.add_argument("filename", help="input audio file")
+	parser = argparse.ArgumentParser(description="Calculate and plot BPM from an audio file, or index the BPM timelines of a folder of mixes.")
+	parser.add_argument("filename", help="input audio file, or a folder to index (headless, see the options below)")
 	parser.add_argument("-s", "--samples", type=int, default=60, help="number of samples")
 	parser.add_argument("-l", "--length", type=int, default=16, help="sample length in seconds")
 	parser.add_argument("-w", "--window", type=float, default=3.0, help="window size in seconds")
 	parser.add_argument("--min-bpm", type=int, default=120, help="minimum safe BPM range")
 	parser.add_argument("--max-bpm", type=int, default=150, help="maximum safe BPM range")
+	parser.add_argument("--workers", type=int, default=1, help="analyse the windows in this many processes (default: 1)")
+	parser.add_argument("--analysis-rate", type=int, default=None, help=f"let ffmpeg decode to mono at this sample rate (e.g. 11025) straight into the analysis, no temporary wav is written (folder mode default: {FOLDER_ANALYSIS_RATE})")
+	parser.add_argument("--hop", type=float, default=None, help="read the whole file once and output a BPM point every HOP seconds (rounded to whole windows), instead of --samples probes (folder mode always does this, by default with HOP = --length)")
+	parser.add_argument("--index", default=None, help=f"folder mode: the index file to store the timelines in (default: {INDEX_FILE_NAME} in the folder)")
+	parser.add_argument("--export-json", default=None, help="folder mode: write every timeline to this JSON file")
+	parser.add_argument("--export-csv", default=None, help="folder mode: write every timeline to this CSV file")
+	parser.add_argument("--plot-dir", default=None, help="folder mode: save a PNG graph of every mix into this folder")
+	add_profile_arguments(parser)
 	args = parser.parse_args()
+	profile_start = start_profiling(args)
 
 	if not os.path.exists(args.filename):
 		print("File not found.")
 		return
 
-	if not args.filename.lower().endswith((".wav", ".wave")):
-		temp_dir = tempfile.gettempdir()
-		converted_file = convertToWav(args.filename, temp_dir)
-		plotBpm(converted_file, args.samples, args.length, args.window, args.min_bpm, args.max_bpm)
-		shutil.rmtree(temp_dir, ignore_errors=True)
+	if os.path.isdir(args.filename):
+		indexFolder(args)
+		finish_profiling(args, profile_start)
+		return
+
+	if args.analysis_rate is None and not args.filename.lower().endswith((".wav", ".wave")):
+		converted_file = convertToWav(args.filename, tempfile.gettempdir())
+		try:
+			analyzeFile(converted_file, args)
+		finally:
+			shutil.rmtree(os.path.dirname(converted_file), ignore_errors=True) # only our mkdtemp folder
 	else:
-		plotBpm(args.filename, args.samples, args.length, args.window, args.min_bpm, args.max_bpm)
+		analyzeFile(args.filename, args)
+
+	finish_profiling(args, profile_start)
+	import matplotlib.pyplot as plt
+	plt.show()
 
 if __name__ == "__main__":
 	main()
\ No newline at end of file
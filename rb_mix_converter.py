@@ -35,12 +35,16 @@ def convert_folder_to_mp3(input_folder, output_folder, output_format):
 				
 				print(f"Converted '{wav_file}' to '{output_file}'")
 
-# Parse command-line arguments
-parser = argparse.ArgumentParser(description='Convert WAV files in a folder to MP3.')
-parser.add_argument('input_folder', type=str, help='Input folder path containing the WAV files')
-parser.add_argument('output_folder', type=str, help='Output folder path containing the MP3 files')
-parser.add_argument('--output-text-format', type=str, default="%Y_%m_%d__%H_%M", help='Output filename date format (default: %(default)s)')
-args = parser.parse_args()
+def main():
+	# Parse command-line arguments
+	parser = argparse.ArgumentParser(description='Convert WAV files in a folder to MP3.')
+	parser.add_argument('input_folder', type=str, help='Input folder path containing the WAV files')
+	parser.add_argument('output_folder', type=str, help='Output folder path containing the MP3 files')
+	parser.add_argument('--output-text-format', type=str, default="%Y_%m_%d__%H_%M", help='Output filename date format (default: %(default)s)')
+	args = parser.parse_args()
 
-# Convert folder to MP3
-convert_folder_to_mp3(args.input_folder, args.output_folder, args.output_text_format)
+	# Convert folder to MP3
+	convert_folder_to_mp3(args.input_folder, args.output_folder, args.output_text_format)
+
+if __name__ == '__main__':
+	main()
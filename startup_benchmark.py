@@ -0,0 +1,66 @@
+import argparse
+import logging
+import os
+import subprocess
+import sys
+
+from utils import *
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+ENTRY_POINTS = [
+	"downloader",
+	"fingerprint",
+	"folder_cutoff",
+	"loudness",
+	"mix_detect",
+	"mix_plot_bpm",
+	"rb_mix_converter",
+	"soundalike_results_analyse",
+	"ytmusic_batch_search",
+]
+
+def get_import_time_ms(module):
+	# cumulative import time of the module (everything it imports included), as reported by python -X importtime
+	result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=SCRIPT_DIR, capture_output=True, text=True)
+	if result.returncode != 0:
+		errors = [line for line in result.stderr.splitlines() if not line.startswith("import time:")]
+		logging.error(f"[{module}] import failed: {errors[-1] if len(errors) > 0 else result.returncode}")
+		return None
+
+	for line in reversed(result.stderr.splitlines()):
+		# import time: self [us] | cumulative | imported package
+		fields = line.split("|")
+		if len(fields) == 3 and fields[2].strip() == module and not fields[2].startswith("  "):
+			return int(fields[1]) / 1000
+	logging.error(f"[{module}] no import time reported")
+	return None
+
+def main():
+	default_budget_ms = 500
+	default_runs = 3
+	parser = argparse.ArgumentParser(description="Measure the import time of every script and fail if one is over the budget.")
+	parser.add_argument("scripts", nargs="*", default=ENTRY_POINTS, help=f"Module names to check (Default: all {len(ENTRY_POINTS)} scripts)")
+	parser.add_argument("--budget-ms", type=float, default=default_budget_ms, help=f"Max allowed import time of a script in milliseconds (Default: {default_budget_ms})")
+	parser.add_argument("--runs", type=int, default=default_runs, help=f"Import every script this many times and keep the fastest, the first run also writes the .pyc files (Default: {default_runs})")
+	args = parser.parse_args()
+	setup_logging(False)
+
+	failed = []
+	for module in args.scripts:
+		times = [get_import_time_ms(module) for _ in range(max(args.runs, 1))]
+		if None in times:
+			failed.append(module)
+			continue
+		best = min(times)
+		mark = "✓" if best <= args.budget_ms else "✕"
+		logging.info(f" {mark}  {module:<28} {best:8.1f} ms")
+		if best > args.budget_ms:
+			failed.append(module)
+
+	if len(failed) > 0:
+		logging.error(f"over the {args.budget_ms} ms budget or failed: {', '.join(failed)}")
+		sys.exit(1)
+	logging.info(f"all scripts are within the {args.budget_ms} ms budget")
+
+if __name__ == "__main__":
+	main()
@@ -5,6 +5,15 @@ import sys
 import json
 import hashlib
 import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+	import resource # not available on windows, peak RSS is not reported there
+except ImportError:
+	resource = None
 
 def setup_logging(enable_debug:bool):
 	target_level = logging.DEBUG if enable_debug else logging.INFO
@@ -17,9 +26,147 @@ def setup_logging(enable_debug:bool):
 	)
 	return
 
-def run_command(command) -> str:
+class Profiler:
+	# Wall/CPU time per named stage plus simple counters, collected from any thread. Does nothing until enabled.
+	def __init__(self):
+		self.enabled = False
+		self._lock = threading.Lock()
+		self.stages = {} # name -> [calls, wall seconds, cpu seconds]
+		self.counters = {}
+
+	@contextmanager
+	def stage(self, name):
+		if not self.enabled:
+			yield
+			return
+		wall_start = time.perf_counter()
+		cpu_start = time.thread_time()
+		try:
+			yield
+		finally:
+			self.add(name, time.perf_counter() - wall_start, time.thread_time() - cpu_start)
+
+	def add(self, name, wall, cpu, calls=1):
+		with self._lock:
+			totals = self.stages.setdefault(name, [0, 0.0, 0.0])
+			totals[0] += calls
+			totals[1] += wall
+			totals[2] += cpu
+
+	def count(self, name, amount=1):
+		if not self.enabled:
+			return
+		with self._lock:
+			self.counters[name] = self.counters.get(name, 0) + amount
+
+	def reset(self, enabled):
+		with self._lock:
+			self.enabled = enabled
+			self.stages = {}
+			self.counters = {}
+
+	def export(self):
+		with self._lock:
+			return {"stages": {name: list(totals) for name, totals in self.stages.items()}, "counters": dict(self.counters)}
+
+	def merge(self, exported):
+		# add the numbers collected in another process (e.g. a process pool worker)
+		for name, (calls, wall, cpu) in exported["stages"].items():
+			self.add(name, wall, cpu, calls)
+		for name, amount in exported["counters"].items():
+			self.count(name, amount)
+
+	def get_peak_rss_mb(self):
+		if resource is None:
+			return None, None
+		scale = 1024 * 1024 if sys.platform == "darwin" else 1024 # bytes on macos, KB elsewhere
+		return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale
+
+	def report(self, total_wall, json_path=None):
+		exported = self.export()
+		peak_rss, peak_rss_children = self.get_peak_rss_mb()
+		lines = [f"{'stage':<28}{'calls':>8}{'wall s':>10}{'cpu s':>10}{'% wall':>8}"]
+		for name, (calls, wall, cpu) in sorted(exported["stages"].items(), key=lambda item: -item[1][1]):
+			lines.append(f"{name:<28}{calls:>8}{wall:>10.2f}{cpu:>10.2f}{100 * wall / max(total_wall, 1e-9):>8.1f}")
+		lines.append(f"{'total (elapsed)':<28}{'':>8}{total_wall:>10.2f}")
+		for name, amount in sorted(exported["counters"].items()):
+			lines.append(f"{name}: {amount}")
+		if peak_rss is not None:
+			lines.append(f"peak RSS: {peak_rss:.1f} MB (largest subprocess: {peak_rss_children:.1f} MB)")
+		print("\n--- profile (stage times are summed over all workers, nested stages are included in their parents) ---")
+		print("\n".join(lines))
+
+		if json_path is not None:
+			exported["total_wall"] = total_wall
+			exported["peak_rss_mb"] = peak_rss
+			exported["peak_rss_children_mb"] = peak_rss_children
+			with open(json_path, 'w') as f:
+				json.dump(exported, f, indent=2)
+			logging.info(f"profile written to {json_path}")
+
+PROFILER = Profiler()
+
+def add_profile_arguments(parser):
+	parser.add_argument('--profile', action='store_true', help='Print a per-stage timing breakdown at the end')
+	parser.add_argument('--profile-json', type=str, default=None, help='Also write the profile to this JSON file (implies --profile)')
+
+def start_profiling(args):
+	PROFILER.reset(args.profile or args.profile_json is not None)
+	return time.perf_counter()
+
+def finish_profiling(args, start_time):
+	if PROFILER.enabled:
+		PROFILER.report(time.perf_counter() - start_time, args.profile_json)
+
+def get_command_stage(command):
+	# default stage name for a shell command: its program name
+	return "cmd: " + os.path.basename(command.split()[0]) if command.strip() else "cmd"
+
+def run_profiled(command, stage=None):
+	# subprocess.run(command, shell=True, capture_output=True), plus the wall and CPU time of the command in the profiler
+	stage = stage or get_command_stage(command)
+	wall_start = time.perf_counter()
+	if not hasattr(os, "wait4"):
+		result = subprocess.run(command, shell=True, capture_output=True)
+		PROFILER.add(stage, time.perf_counter() - wall_start, 0.0)
+		return result
+
+	# like communicate(), but reaping the child ourselves gives us its own rusage even with parallel commands
+	process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	stderr_chunks = []
+	stderr_reader = threading.Thread(target=lambda: stderr_chunks.append(process.stderr.read()))
+	stderr_reader.start()
+	stdout = process.stdout.read()
+	stderr_reader.join()
+	process.stdout.close()
+	process.stderr.close()
+	wait_profiled(process, stage, wall_start)
+	return subprocess.CompletedProcess(command, process.returncode, stdout, stderr_chunks[0])
+
+def wait_profiled(process, stage, wall_start):
+	# process.wait() for a Popen child that is not reaped yet (don't poll() it before), plus its wall and CPU time in the profiler
+	if not PROFILER.enabled or not hasattr(os, "wait4"):
+		process.wait()
+		if PROFILER.enabled:
+			PROFILER.add(stage, time.perf_counter() - wall_start, 0.0)
+		return process.returncode
+	_, status, rusage = os.wait4(process.pid, 0)
+	process.returncode = os.waitstatus_to_exitcode(status)
+	PROFILER.add(stage, time.perf_counter() - wall_start, rusage.ru_utime + rusage.ru_stime)
+	return process.returncode
+
+def try_command(command, stage=None) -> subprocess.CompletedProcess:
+	# runs the command and returns the result with text output, failures are left to the caller (e.g. for retrying)
 	logging.debug(f"running command: {command}")
-	result = subprocess.run(command, shell=True, capture_output=True, text=True)
+	if PROFILER.enabled:
+		result = run_profiled(command, stage)
+		result.stdout = result.stdout.decode(errors="replace")
+		result.stderr = result.stderr.decode(errors="replace")
+		return result
+	return subprocess.run(command, shell=True, capture_output=True, text=True)
+
+def run_command(command, stage=None) -> str:
+	result = try_command(command, stage)
 	if result.returncode != 0:
 		logging.error(f"command failed: {command}")
 		logging.error(result.stderr)
@@ -27,6 +174,45 @@ def run_command(command) -> str:
 	return_text = result.stdout + result.stderr
 	return return_text # ffmpeg returns the analysis data in stderr somehow
 
+def run_command_bytes(command, stage=None) -> bytes:
+	# same as run_command, but returns the raw stdout (for piping decoded audio into numpy)
+	logging.debug(f"running command: {command}")
+	if PROFILER.enabled:
+		result = run_profiled(command, stage)
+	else:
+		result = subprocess.run(command, shell=True, capture_output=True)
+	if result.returncode != 0:
+		logging.error(f"command failed: {command}")
+		logging.error(result.stderr.decode(errors="replace"))
+		sys.exit(1)
+	return result.stdout
+
+def iter_ffmpeg_pcm(command, frame_bytes, block_bytes):
+	# raw PCM from a command that writes it to stdout (ffmpeg), block_bytes at a time, the last block can be shorter, always whole frames
+	# the command is profiled like run_command's and a failure exits the same way, nothing is buffered past one block
+	logging.debug(f"running command: {command}")
+	block_bytes -= block_bytes % frame_bytes
+	wall_start = time.perf_counter()
+	process = subprocess.Popen("exec " + command, shell=True, stdout=subprocess.PIPE) # exec: kill() has to reach ffmpeg, not the shell
+	at_end = False
+	try:
+		while not at_end:
+			with PROFILER.stage("ffmpeg decode"):
+				raw = process.stdout.read(block_bytes)
+			at_end = len(raw) < block_bytes
+			raw = raw[:len(raw) - len(raw) % frame_bytes]
+			if len(raw) > 0:
+				yield raw
+	finally:
+		if not at_end:
+			process.kill() # the caller stopped early
+		process.stdout.close()
+		wait_profiled(process, get_command_stage(command), wall_start)
+
+	if process.returncode != 0:
+		logging.error(f"command failed: {command}")
+		sys.exit(1)
+
 def extract_ffmpeg_json(output:str):
 	start_idx = output.find('{')
 	end_idx = output.rfind('}') + 1
@@ -35,6 +221,9 @@ def extract_ffmpeg_json(output:str):
 	logging.debug(f"extracted json data: {data}")
 	return data
 
+LOUDNESS_METERS = ["numpy", "ffmpeg"]
+DEFAULT_LOUDNESS_METER = "numpy"
+
 def get_loudness_values(json_data, from_input=True):
 	tag = "input" if from_input else "output"
 	i = float(json_data[tag + "_i"])
@@ -43,15 +232,32 @@ def get_loudness_values(json_data, from_input=True):
 	thresh = float(json_data[tag + "_thresh"])
 	return i, tp, lra, thresh
 
-def get_song_loudness_data(input_file_path:str):
+def get_audio_info(input_file_path:str):
+	# duration (seconds), sample rate and channel count of the first audio stream
+	probe_command = f'ffprobe -v error -select_streams a:0 -show_entries stream=sample_rate,channels:format=duration -of json "{input_file_path}"'
+	probe_data = extract_ffmpeg_json(run_command(probe_command, stage="ffprobe"))
+	stream = probe_data["streams"][0]
+	return float(probe_data["format"]["duration"]), int(stream["sample_rate"]), int(stream["channels"])
+
+def get_song_loudness_data(input_file_path:str, meter:str=DEFAULT_LOUDNESS_METER, cache=None):
+	# integrated, true peak, LRA and threshold of the file, "numpy" measures it from a single decode (loudness.py), "ffmpeg" with a loudnorm pass
+	if meter == "numpy":
+		from loudness import measure_file
+		return measure_file(input_file_path, cache)
 	analyze_command = f"ffmpeg -i '{input_file_path}' -af loudnorm=print_format=json -f null -"
-	out = run_command(analyze_command)
+	out = run_command(analyze_command, stage="ffmpeg loudness analysis")
 	analysis_data = extract_ffmpeg_json(out)
 	return get_loudness_values(analysis_data, from_input=True)
 
-def normalize_to_mp3(input_wav_path:str, output_mp3_path:str, target_tp:float=-0.1, target_lufs:float=-10.0) -> bool:
-	# analyze the file with ffmpeg
-	input_integrated, input_tp, input_lra, input_thresh = get_song_loudness_data(input_wav_path)
+def normalize_to_mp3(input_wav_path:str, output_mp3_path:str, target_tp:float=-0.1, target_lufs:float=-10.0, meter:str=DEFAULT_LOUDNESS_METER, cache=None) -> bool:
+	# analyze the file, the measured values go into loudnorm so the encode is a single linear pass
+	loudness = get_song_loudness_data(input_wav_path, meter, cache)
+	return encode_normalized_mp3(input_wav_path, output_mp3_path, loudness, target_tp, target_lufs)
+
+def encode_normalized_mp3(input_file_path:str, output_mp3_path:str, loudness, target_tp:float=-0.1, target_lufs:float=-10.0) -> bool:
+	# loudness: the measured (integrated, true peak, LRA, threshold) of the input, see get_song_loudness_data
+	# the input can be anything ffmpeg reads (e.g. a downloaded opus/m4a stream), it is decoded once, in this pass
+	input_integrated, input_tp, input_lra, input_thresh = [round(value, 2) for value in loudness]
 
 	# calculate the required gain
 	required_gain = round(target_lufs - input_integrated, 2)
@@ -67,13 +273,13 @@ def normalize_to_mp3(input_wav_path:str, output_mp3_path:str, target_tp:float=-0
 
 	# normalize & convert to mp3
 	normalize_command = (
-		f"ffmpeg -i '{input_wav_path}' "
+		f"ffmpeg -i '{input_file_path}' "
 		f"-af loudnorm=I={target_lufs}:TP={target_tp}:LRA={input_lra}:linear=true:"
 		f"measured_I={input_integrated}:measured_TP={input_tp}:"
 		f"measured_LRA={input_lra}:measured_thresh={input_thresh}:print_format=json "
 		f"-c:a libmp3lame -b:a 320k '{output_mp3_path}'"
 	)
-	out = run_command(normalize_command)
+	out = run_command(normalize_command, stage="ffmpeg encode")
 
 	# check if we got linear or not
 	normalize_results = extract_ffmpeg_json(out)
@@ -98,6 +304,90 @@ def get_file_hash(filename):
 	# Calculate the MD5 hash of a file's name
 	return hashlib.md5(filename.encode('utf-8')).hexdigest()
 
+def get_file_identity(filename):
+	# size + mtime is enough to notice a changed file without reading it
+	stat = os.stat(filename)
+	return stat.st_size, stat.st_mtime_ns
+
+class ResultCache:
+	# persistent per-file result store (sqlite), entries are invalidated when the file's size/mtime or the analysis params change
+	COMMIT_INTERVAL = 100
+
+	def __init__(self, db_path):
+		self.db_path = db_path
+		self.hits = 0
+		self.misses = 0
+		self._lock = threading.Lock()
+		self._pending = 0
+		self._db = sqlite3.connect(db_path, check_same_thread=False)
+		self._db.execute("PRAGMA journal_mode=WAL")
+		self._db.execute(
+			"CREATE TABLE IF NOT EXISTS results ("
+			"path TEXT NOT NULL, params TEXT NOT NULL, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, value TEXT NOT NULL, "
+			"PRIMARY KEY (path, params))"
+		)
+		self._db.commit()
+
+	@staticmethod
+	def _params_key(params):
+		return json.dumps(params, sort_keys=True)
+
+	def get(self, file_path, params):
+		path = os.path.abspath(file_path)
+		size, mtime_ns = get_file_identity(path)
+		with self._lock:
+			row = self._db.execute(
+				"SELECT size, mtime_ns, value FROM results WHERE path = ? AND params = ?",
+				(path, self._params_key(params))
+			).fetchone()
+			if row is None or row[0] != size or row[1] != mtime_ns:
+				self.misses += 1
+				PROFILER.count("cache misses")
+				return None
+			self.hits += 1
+		PROFILER.count("cache hits")
+		return json.loads(row[2])
+
+	def put(self, file_path, params, value):
+		path = os.path.abspath(file_path)
+		size, mtime_ns = get_file_identity(path)
+		with self._lock:
+			self._db.execute(
+				"INSERT OR REPLACE INTO results (path, params, size, mtime_ns, value) VALUES (?, ?, ?, ?, ?)",
+				(path, self._params_key(params), size, mtime_ns, json.dumps(value))
+			)
+			self._pending += 1
+			if self._pending >= self.COMMIT_INTERVAL:
+				self._db.commit()
+				self._pending = 0
+
+	def remove(self, file_path):
+		path = os.path.abspath(file_path)
+		with self._lock:
+			self._db.execute("DELETE FROM results WHERE path = ?", (path,))
+			self._pending += 1
+
+	def move(self, old_file_path, new_file_path):
+		# keep the entries of a renamed file (its contents did not change)
+		old_path = os.path.abspath(old_file_path)
+		new_path = os.path.abspath(new_file_path)
+		size, mtime_ns = get_file_identity(new_path)
+		with self._lock:
+			self._db.execute("DELETE FROM results WHERE path = ?", (new_path,))
+			self._db.execute("UPDATE results SET path = ?, size = ?, mtime_ns = ? WHERE path = ?", (new_path, size, mtime_ns, old_path))
+			self._pending += 1
+
+	def flush(self):
+		with self._lock:
+			if self._pending > 0:
+				self._db.commit()
+				self._pending = 0
+
+	def close(self):
+		with self._lock:
+			self._db.commit()
+			self._db.close()
+
 def get_files_recursive(directory):
 	file_list = []
 	for root, directories, files in os.walk(directory):
@@ -105,8 +395,42 @@ def get_files_recursive(directory):
 			file_list.append(os.path.join(root, file))
 	return file_list
 
-def get_thread_count(is_debug):
+def get_thread_count(is_debug, requested=None):
 	if is_debug:
 		return 1
+	elif requested is not None:
+		return max(requested, 1)
 	else:
-		return min(os.cpu_count() - 1, 8) # clamp to max 8 and also leave 1 core free
+		return max(min(os.cpu_count() - 1, 8), 1) # clamp to max 8 and also leave 1 core free
+
+def pcm_to_float(raw, sample_width):
+	# little-endian integer PCM (bytes, or a uint8 array of whole samples) to float32 samples in [-1, 1), 8-bit is unsigned like in wav files
+	import numpy as np
+	data = np.ascontiguousarray(np.frombuffer(raw, dtype=np.uint8) if isinstance(raw, (bytes, bytearray)) else raw, dtype=np.uint8).ravel()
+	if sample_width == 1:
+		return (data.astype(np.float32) - 128) / 128
+	if sample_width == 2:
+		return data.view('<i2').astype(np.float32) / 2. ** 15
+	if sample_width == 3:
+		# shift the 3 bytes to the top of an int32, the sign comes for free
+		padded = np.zeros((len(data) // 3, 4), dtype=np.uint8)
+		padded[:, 1:] = data.reshape(-1, 3)
+		return padded.view('<i4').ravel().astype(np.float32) / 2. ** 31
+	if sample_width == 4:
+		return data.view('<i4').astype(np.float32) / 2. ** 31
+	raise ValueError(f"unsupported sample width: {sample_width}")
+
+def create_shared_array(array):
+	# copy a numpy array into a new shared memory block, the caller has to close() and unlink() it when done
+	import numpy as np
+	from multiprocessing import shared_memory
+	shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+	np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[:] = array
+	return shm
+
+def attach_shared_array(name, shape, dtype):
+	# view a block made by create_shared_array from another process, close() the returned shm after dropping the array
+	import numpy as np
+	from multiprocessing import shared_memory
+	shm = shared_memory.SharedMemory(name=name)
+	return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
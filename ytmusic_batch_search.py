@@ -1,10 +1,11 @@
-import ytmusicapi
 import subprocess
 import argparse
 import concurrent.futures
 import os
+import threading
 
-yt = ytmusicapi.YTMusic(".oauth.json")
+yt = None # created on first use, not at import
+ytLock = threading.Lock()
 maxLegnth = 0
 errorList = []
 
@@ -15,10 +16,18 @@ def error(msg):
 	global errorList
 	errorList.append(msg)
 
+def get_client():
+	global yt
+	with ytLock:
+		if yt is None:
+			import ytmusicapi
+			yt = ytmusicapi.YTMusic(".oauth.json")
+	return yt
+
 def process_line(line):
 	line = line.strip()
 	try:
-		results = yt.search(line, filter='songs', limit=1)
+		results = get_client().search(line, filter='songs', limit=1)
 		if len(results) > 0 and "videoId" in results[0]:
 			videoid = results[0]["videoId"]
 			command = f'yt-dlp -J "https://music.youtube.com/watch?v={videoid}" | jq ".duration"'